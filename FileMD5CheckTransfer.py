@@ -11,18 +11,40 @@
 # - created md5 checksum for them
 #
 
+import bz2
 import hashlib
 import os
+import re
+import stat
+import mmap
+import errno
+import fcntl
+import fnmatch
 import tarfile
+import posixpath
+import sqlite3
 import logging
 import datetime
 import shutil
 import sys
+import time
 import argparse
+import json
+import cProfile
+import contextlib
+import threading
+import multiprocessing
+import Queue
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from random import choice
 from string import ascii_uppercase
 from string import digits
 import paramiko
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 # temporary directory's
 TEMP_DIR = ''
@@ -31,9 +53,24 @@ TEMP_DIR_UNCOMPRESS = ''
 # backup directory
 BACKUP_PATH = ''
 
+# dated backup directories link to files kept once per md5 here
+BACKUP_STORE = 'objects/'
+
+# format of dated backup directories
+BACKUP_FORMAT = "%Y-%m-%d_%H_%M"
+
 # path to the log file
 N_LOGFILE = ''
 
+# path to the transfer manifest (sqlite), empty to disable it
+MANIFEST_PATH = ''
+
+# directory for JSON run reports (report_<queue>.json), empty to disable
+REPORT_DIR = ''
+
+# directory for Prometheus textfile collector, empty to disable
+PROMETHEUS_DIR = ''
+
 # SFTP settings
 NODETWO_PORT = 22
 NODETWO_IP = ''
@@ -44,6 +81,299 @@ NODEONE_IP = ''
 NODEONE_USERNAME = ''
 NODEONE_PUBLIC_KEY = ''
 
+# number of concurrent SFTP transfers per host
+WORKERS = 4
+
+# order of transfers: listing (as server returns them), smallest
+# (smallest files first) or priority (PRIORITIES, then smallest)
+ORDER = 'listing'
+
+# priority of file type prefixes, lower goes first, e.g. {'RP': 0}
+PRIORITIES = {}
+
+# bytes per second for all transfers together, 0 for no limit
+BWLIMIT = 0
+
+# seconds between keepalive packets on idle SSH sessions
+KEEPALIVE = 30
+
+# read/write buffer for streamed transfers
+CHUNK_SIZE = 1024 * 1024
+
+# chunks buffered between tar extraction and upload
+INFLIGHT_CHUNKS = 8
+
+# failed transfers are resumed RETRIES times, waiting RETRY_DELAY
+# seconds (doubled every time) before each of them
+RETRIES = 3
+RETRY_DELAY = 2
+
+# bytes compared at the start and end of a partial file before resuming
+VERIFY_SIZE = 64 * 1024
+
+# number of processes verifying and uncompressing archives
+PROCESSES = multiprocessing.cpu_count()
+
+# checksum algorithms created for reports, md5 is what partners expect
+CHECKSUMS = ['md5']
+
+# read buffer used for hashing, with HASH_MMAP files are mapped instead
+HASH_BUFFER = 1024 * 1024
+HASH_MMAP = False
+
+# reports sent to nodetwo are packed as tar.bz2 (or tar.xz) when set,
+# compressed by blocks of PACKAGE_BLOCK bytes on all processes
+PACKAGE = ''
+PACKAGE_BLOCK = 900 * 1000
+
+
+def hash_file(filename, algorithms=('md5',)):
+    '''
+    This function return {algorithm: hexdigest} of the file,
+    all digests are computed from one read of it.
+    '''
+    hashes = [(i, hashlib.new(i)) for i in algorithms]
+    with open(filename, 'rb') as f:
+        if HASH_MMAP and os.fstat(f.fileno()).st_size:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for name, h in hashes:
+                    h.update(data)
+            finally:
+                data.close()
+        else:
+            while True:
+                data = f.read(HASH_BUFFER)
+                if not data:
+                    break
+                for name, h in hashes:
+                    h.update(data)
+    return dict((name, h.hexdigest()) for name, h in hashes)
+
+
+def hash_job(job):
+    '''
+    This function hash one file in a worker process.
+    job: (filename, algorithms)
+    Return (filename, {algorithm: hexdigest} or None, error).
+    '''
+    filename, algorithms = job
+    try:
+        return (filename, hash_file(filename, algorithms), None)
+    except Exception as error:
+        return (filename, None, str(error))
+
+
+def md5_file(filename):
+    '''
+    This function return md5 hexdigest of the file.
+    '''
+    return hash_file(filename)['md5']
+
+
+def checksum_algorithm(filename):
+    '''
+    This function return algorithm of checksum file
+    (name.md5, name.sha256, ...) or None for other files.
+    '''
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if '.' in filename and extension in hashlib.algorithms_available:
+        return extension
+    return None
+
+
+def read_checksum_file(filename):
+    '''
+    This function return {file name: hexdigest} from checksum file
+    written by md5sum/sha256sum or by this script.
+    '''
+    checksums = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                name = os.path.basename(fields[1].strip().lstrip('*'))
+                checksums[name] = fields[0]
+    return checksums
+
+
+def read_md5_file(filename):
+    '''
+    This function return md5 sum saved next to compressed file
+    or False when there is no md5 file.
+    '''
+    localfile = filename.split('.tar.bz2')[0] + '.md5'
+    if not os.path.exists(localfile):
+        return False
+    with open(localfile, 'r') as f:
+        return f.read().split(' ')[0].rstrip()
+
+
+def match_file(filename, file_type, regex=False):
+    '''
+    This function check if file name is of given type: prefix,
+    glob or regular expression
+    '''
+    if regex:
+        return re.match(file_type, filename) is not None
+    if any(i in file_type for i in '*?['):
+        return fnmatch.fnmatch(filename, file_type)
+    return filename.startswith(file_type)
+
+
+def compress_block(job):
+    '''
+    This function compress one block into a complete bz2 (or xz)
+    stream in a worker process, caller writes streams one after
+    another like pbzip2 does.
+    job: (method, data)
+    '''
+    method, data = job
+    if method == 'xz':
+        return lzma.compress(data)
+    return bz2.compress(data, 9)
+
+
+def tar_blocks(filename, arcname, size=PACKAGE_BLOCK):
+    '''
+    This function yield tar archive with one file in blocks of size
+    bytes, the archive is never written uncompressed.
+    '''
+    st = os.stat(filename)
+    info = tarfile.TarInfo(arcname)
+    info.size = st.st_size
+    info.mtime = st.st_mtime
+    info.mode = stat.S_IMODE(st.st_mode)
+    header = info.tobuf(tarfile.GNU_FORMAT)
+    written = len(header) + info.size
+    # end of file and archive padding, as tarfile writes it
+    trailer = '\0' * (-info.size % tarfile.BLOCKSIZE + 2 * tarfile.BLOCKSIZE)
+    written += len(trailer)
+    trailer += '\0' * (-written % tarfile.RECORDSIZE)
+
+    data = header
+    with open(filename, 'rb') as f:
+        left = info.size
+        while left > 0:
+            chunk = f.read(min(size, left))
+            if not chunk:
+                raise IOError('%s changed while packing it' % filename)
+            left -= len(chunk)
+            data += chunk
+            while len(data) >= size:
+                yield data[:size]
+                data = data[size:]
+    data += trailer
+    while data:
+        yield data[:size]
+        data = data[size:]
+
+
+class BZ2Reader(object):
+    '''
+    BZ2Reader will read bz2 file made of many streams (pbzip2 or
+    packed reports), bz2 module of Python 2 stops after the first one.
+    :param fileobj: compressed file
+    '''
+    def __init__(self, fileobj):
+        ''' init method '''
+        self.fileobj = fileobj
+        self.decompressor = bz2.BZ2Decompressor()
+        # uncompressed chunks, offset of the first unread byte
+        # in the first one and number of unread bytes
+        self.chunks = deque()
+        self.offset = 0
+        self.size = 0
+        self.unused = ''
+
+    def read(self, size=-1):
+        '''
+        This function return up to size uncompressed bytes
+        '''
+        while size < 0 or self.size < size:
+            data = self.unused or self.fileobj.read(CHUNK_SIZE)
+            self.unused = ''
+            if not data:
+                break
+            try:
+                data = self.decompressor.decompress(data)
+                if data:
+                    self.chunks.append(data)
+                    self.size += len(data)
+            except EOFError:
+                # previous stream ended exactly at the end of a chunk
+                self.decompressor = bz2.BZ2Decompressor()
+                self.unused = data
+                continue
+            if self.decompressor.unused_data:
+                self.unused = self.decompressor.unused_data
+                self.decompressor = bz2.BZ2Decompressor()
+        # only the returned bytes are copied, not the whole buffer
+        if size < 0 or size > self.size:
+            size = self.size
+        parts = []
+        left = size
+        while left:
+            chunk = self.chunks[0]
+            part = chunk[self.offset:self.offset + left]
+            parts.append(part)
+            left -= len(part)
+            self.offset += len(part)
+            if self.offset == len(chunk):
+                self.chunks.popleft()
+                self.offset = 0
+        self.size -= size
+        return ''.join(parts)
+
+
+def open_archive(filename):
+    '''
+    This function open tar archive to be read as a stream,
+    bz2 archives are read to the end of their last stream.
+    '''
+    f = open(filename, 'rb')
+    if f.read(3) == 'BZh':
+        f.seek(0)
+        return tarfile.open(fileobj=BZ2Reader(f), mode='r|')
+    f.seek(0)
+    return tarfile.open(fileobj=f, mode='r|*')
+
+
+def verify_uncompress(job):
+    '''
+    This function verify md5 of one compressed file and uncompress it.
+    It runs in a worker process, so it does not log anything and
+    return (filename, verified, error, seconds) to the caller instead,
+    seconds is {'md5': spent hashing, 'extract': spent uncompressing}.
+    job: (filename, md5 computed already or None, destination or None,
+          (algorithm, hexdigest) from batch checksum file or None)
+    '''
+    filename, digest, destination, batch = job
+    seconds = {'md5': 0.0, 'extract': 0.0}
+    try:
+        algorithm, expected = 'md5', read_md5_file(filename)
+        if not expected and batch:
+            algorithm, expected = batch
+        if not expected:
+            return (filename, False, 'No md5 file!', seconds)
+        if algorithm != 'md5' or not digest:
+            start = time.time()
+            digest = hash_file(filename, [algorithm])[algorithm]
+            seconds['md5'] = time.time() - start
+        if digest != expected:
+            return (filename, False, None, seconds)
+        if destination is not None:
+            if not tarfile.is_tarfile(filename):
+                return (filename, True, 'No such file', seconds)
+            start = time.time()
+            tar = open_archive(filename)
+            tar.extractall(destination)
+            tar.close()
+            seconds['extract'] = time.time() - start
+    except Exception as error:
+        return (filename, False, str(error), seconds)
+    return (filename, True, None, seconds)
+
 
 class Logs(object):
     ''' Logs class for dealing with logfile and levels '''
@@ -61,7 +391,15 @@ class Files(object):
     :param nodetwo_dir: this is remote dir on nodetwo sftp server
     :param nodeone_dir: this is a remote dir on nodeone sftp
     '''
-    def __init__(self, file_type, nodetwo_dir, nodeone_dir):
+    def __init__(self, file_type, nodetwo_dir, nodeone_dir, workers=WORKERS,
+                 stream=False, stream_extract=False, processes=PROCESSES,
+                 manifest=MANIFEST_PATH, backup_store=False, pools=None,
+                 min_age=0, regex=False, checksums=None,
+                 batch_checksums=False, order=ORDER, priorities=None,
+                 nodeone_workers=None, nodetwo_workers=None,
+                 bwlimit=BWLIMIT, report=REPORT_DIR,
+                 prometheus=PROMETHEUS_DIR, profile=None,
+                 package=PACKAGE):
         ''' initialize few settings '''
         self.queue = self.__random_string()
         logging.info('%s Started', self.queue)
@@ -70,12 +408,68 @@ class Files(object):
         self.file_type = file_type
         self.nodetwo_remote_path = nodetwo_dir
         self.nodeone_remote_path = nodeone_dir
+        self.workers = workers
+        self.stream = stream
+        self.stream_extract = stream_extract
+        self.processes = processes
+        self.digests = {}
+        self.sources = {}
+        # archives uncompressed into temp_uncompress by this run
+        self.extracted = []
+        self.manifest = Manifest(manifest) if manifest else None
+        if self.manifest:
+            # files of this run are not taken over while it is going on
+            self.manifest.hold(self.queue)
+        self.backup_store = backup_store
+        self.pools = pools or {}
+        self.min_age = min_age
+        self.regex = regex
+        self.attributes = {}
+        self.checksums = checksums or CHECKSUMS
+        self.batch_checksums = batch_checksums
+        self.order = order
+        self.priorities = PRIORITIES if priorities is None else priorities
+        self.nodeone_workers = nodeone_workers or workers
+        self.nodetwo_workers = nodetwo_workers or workers
+        self.throttle = Throttle(bwlimit) if bwlimit else None
+        self.metrics = Metrics(self.queue, file_type)
+        self.report = report
+        self.prometheus = prometheus
+        self.profile = profile
+        self.package = package
+        self.hashes = {}
 
         if not os.path.exists(self.temp):
             self.temp_dir(self.temp)
 
     def main(self, prefix):
-        ''' main method for all steps '''
+        '''
+        main method, runs all steps (under cProfile with profile)
+        and saves metrics of the run
+        '''
+        self.metrics.direction = prefix
+        try:
+            if self.profile:
+                profiler = cProfile.Profile()
+                try:
+                    profiler.runcall(self.__main, prefix)
+                finally:
+                    profiler.dump_stats(self.profile)
+                    logging.info(
+                        '%s Profile saved to %s', self.queue, self.profile)
+            else:
+                self.__main(prefix)
+        finally:
+            if self.manifest:
+                self.manifest.release()
+            self.metrics.finish()
+            if self.report:
+                self.metrics.save_json(self.report)
+            if self.prometheus:
+                self.metrics.save_prometheus(self.prometheus)
+
+    def __main(self, prefix):
+        ''' all steps of one run '''
         if prefix == 'nodetwo':
 
             if not os.path.exists(self.temp_uncompress):
@@ -84,41 +478,51 @@ class Files(object):
             logging.info(
                 '%s Connecting to nodeone SFTP server.',
                 self.queue)
-            b = SFTPConnect(NODEONE_IP,
-                            NODEONE_USERNAME,
-                            NODEONE_PUBLIC_KEY,
-                            self.queue, NODEONE_PORT)
+            with self.metrics.timer('connect'):
+                b = self.__pool('nodeone')
 
-            # Download new files
-            for i in b.sftp_list_files(self.nodetwo_remote_path,
-                                       self.file_type):
-                b.sftp_get_file(i, self.temp)
+            # Take over files left by an interrupted run
+            pending = self.__resume(self.nodetwo_remote_path)
 
-                # Backup new files
-                self.__backup_file(i, BACKUP_PATH)
+            # Download, backup and delete new files
+            with self.metrics.timer('list'):
+                downloads = self.__list_files(b, self.nodetwo_remote_path,
+                                              pending)
+            with self.metrics.timer('download'):
+                self.__count('download',
+                             b.run(self.__fetch_file, downloads,
+                                   self.nodetwo_remote_path, self.queue))
 
-                # Delete file from SFTP Server
-                # Hash it if you want to keep them.
-                b.sftp_remove_file(i)
+            # Check MD5 sum of new files and uncompress them
+            with self.metrics.timer('verify'):
+                archives = self.__verify_uncompress()
 
-            # Check MD5 sum of new files
-            for root, dirs, files in os.walk(self.temp):
-                for i in files:
-                    if self.__compare_md5(self.temp + i):
-                        self.__uncompress(self.temp + i)
+            # Upload archive members while they are uncompressed
+            if self.stream_extract:
+                with self.metrics.timer('extract_upload'):
+                    self.__count('extract_upload',
+                                 b.run(self.__uncompress_upload, archives,
+                                       queue=self.queue))
 
             # Copy OB files to Traveller
             if self.file_type.startswith('OB'):
-                self.__ob_to_traveller()
+                with self.metrics.timer('convert'):
+                    self.__ob_to_traveller()
 
             # Upload uncompressed files
+            uploads = []
             for root, dirs, files in os.walk(self.temp_uncompress):
-                for i in files:
-                    logging.info(
-                        '%s Uploading file: %s to nodeone SFTP server',
-                        self.queue, i)
-                    b.sftp_upload_file(self.temp_uncompress + i,
-                                       self.nodeone_remote_path + i)
+                uploads.extend(files)
+            uploads = self.__schedule(uploads, self.temp_uncompress)
+            with self.metrics.timer('upload'):
+                results = b.run(self.__upload_nodeone, uploads,
+                                queue=self.queue)
+            self.__count('upload', results)
+            # streamed archives were marked by __uncompress_upload(),
+            # archives which were not uncompressed are not uploaded
+            if not self.stream_extract and all(results):
+                for i in self.extracted:
+                    self.__mark(self.temp + i, 'uploaded')
 
             # Deleted old temp files
             try:
@@ -127,7 +531,9 @@ class Files(object):
                     self.queue, self.temp, self.temp_uncompress)
                 shutil.rmtree(self.temp)
                 shutil.rmtree(self.temp_uncompress)
-                b.sftp_close()
+                if self.manifest:
+                    self.manifest.forget(self.temp)
+                self.__close(b)
             except Exception as error:
                 logging.info(
                     "%s Cannot delete: %s or %s error: %s",
@@ -138,41 +544,46 @@ class Files(object):
             logging.info(
                 '%s Connecting to nodeone SFTP server.',
                 self.queue)
-            b = SFTPConnect(NODEONE_IP,
-                            NODEONE_USERNAME,
-                            NODEONE_PUBLIC_KEY,
-                            self.queue, NODEONE_PORT)
+            with self.metrics.timer('connect'):
+                b = self.__pool('nodeone')
 
-            # Download new files/reports
-            for i in b.sftp_list_files(self.nodeone_remote_path,
-                                       self.file_type):
-                b.sftp_get_file(i, self.temp)
+            # Take over files left by an interrupted run
+            pending = self.__resume(self.nodeone_remote_path)
 
-                # Backup new files
-                self.__backup_file(i, BACKUP_PATH)
+            # Download, backup and delete new files/reports
+            with self.metrics.timer('list'):
+                downloads = self.__list_files(b, self.nodeone_remote_path,
+                                              pending)
+            with self.metrics.timer('download'):
+                self.__count('download',
+                             b.run(self.__fetch_file, downloads,
+                                   self.nodeone_remote_path, self.queue))
+            self.__close(b)
 
-                # Delete file from SFTP server
-                b.sftp_remove_file(i)
+            # Pack reports into compressed archives
+            if self.package:
+                with self.metrics.timer('package'):
+                    self.__package_files()
 
-            # Create MD5 for file
-            for root, dirs, files in os.walk(self.temp):
-                for i in files:
-                    self.__create_md5(self.temp + i)
+            # Create MD5 (and other checksums) for files
+            with self.metrics.timer('checksum'):
+                self.__create_checksums()
 
             # Connect to SFTP nodetwo
             logging.info('%s Connecting to nodetwo server.', self.queue)
-            s = SFTPConnect(NODETWO_IP,
-                            NODETWO_USERNAME,
-                            NODETWO_PUBLIC_KEY,
-                            self.queue, NODETWO_PORT)
+            with self.metrics.timer('connect'):
+                s = self.__pool('nodetwo')
 
             # Upload new files to nodetwo SFTP server
+            uploads = []
             for root, dirs, files in os.walk(self.temp):
-                for i in files:
-                    logging.info(
-                        '%s Uploading file: %s to: %s',
-                        self.queue, i, self.nodetwo_remote_path)
-                    s.sftp_upload_file(self.temp + i, self.nodetwo_remote_path + i)
+                uploads.extend(files)
+            uploads = self.__schedule(uploads, self.temp)
+            with self.metrics.timer('upload'):
+                self.__count('upload',
+                             s.run(self.__upload_nodetwo, uploads,
+                                   queue=self.queue))
+            self.__close(s)
             try:
                 logging.info('%s Deleting %s', self.queue, self.temp)
                 shutil.rmtree(self.temp)
@@ -185,116 +596,543 @@ class Files(object):
             sys.exit(1)
         logging.info('%s Finished.', self.queue)
 
-    def __check_md5(self, filename):
+    def __pool(self, name):
+        '''
+        This function return shared SFTPPool or connect a new one
+        '''
+        if name in self.pools:
+            return self.pools[name]
+        if name == 'nodeone':
+            return SFTPPool(NODEONE_IP,
+                            NODEONE_USERNAME,
+                            NODEONE_PUBLIC_KEY,
+                            self.queue, NODEONE_PORT,
+                            self.nodeone_workers, self.throttle)
+        return SFTPPool(NODETWO_IP,
+                        NODETWO_USERNAME,
+                        NODETWO_PUBLIC_KEY,
+                        self.queue, NODETWO_PORT,
+                        self.nodetwo_workers, self.throttle)
+
+    def __schedule(self, filenames, directory=None):
+        '''
+        This function order files before transfer.
+        Sizes come from the listing or from files in local directory.
+        '''
+        if self.order not in ('smallest', 'priority'):
+            return filenames
+
+        def size(filename):
+            ''' size of listed or local file '''
+            if directory is not None:
+                return os.path.getsize(directory + filename)
+            return self.attributes[filename].st_size
+
+        def priority(filename):
+            ''' priority of the longest matching prefix, unknown go last '''
+            prefixes = [i for i in self.priorities if filename.startswith(i)]
+            if self.order != 'priority':
+                return 0
+            if not prefixes:
+                return sys.maxint
+            return self.priorities[max(prefixes, key=len)]
+
+        return sorted(filenames, key=lambda i: (priority(i), size(i)))
+
+    def __count(self, stage, results):
+        '''
+        This function count failed items of SFTPPool.run results
+        '''
+        self.metrics.add(stage, failures=len([i for i in results if not i]))
+
+    def __close(self, pool):
+        '''
+        This function close SFTPPool unless it is shared
+        '''
+        if pool not in self.pools.values():
+            pool.close()
+
+    def __list_files(self, pool, directory, pending):
+        '''
+        This function list new files with their attributes and
+        return their names
+        '''
+        files = pool.sftp_list_attr(directory, self.file_type,
+                                    not pending, self.min_age,
+                                    self.regex, self.queue)
+        for i in files:
+            self.attributes[i.filename] = i
+        return self.__schedule([i.filename for i in files])
+
+    def __fetch_file(self, sftp, filename):
+        '''
+        This function download, backup and remove one remote file
+        '''
+        key = None
+        if self.manifest:
+            if filename in self.attributes:
+                key = (posixpath.join(sftp.directory, filename),
+                       self.attributes[filename].st_size,
+                       self.attributes[filename].st_mtime)
+            else:
+                key = (posixpath.join(sftp.directory, filename),) + \
+                    sftp.sftp_stat(filename)
+            entry = self.manifest.get(*key)
+            if entry and self.__owned(entry):
+                logging.info(
+                    '%s %s is transferred by %s, skipping it',
+                    self.queue, filename, entry['queue'])
+                return True
+            if entry and entry['uploaded']:
+                logging.info(
+                    '%s %s was delivered already, skipping it',
+                    self.queue, filename)
+                return self.__remove_file(sftp, filename)
+            if entry and self.__adopt(entry):
+                return self.__remove_file(sftp, filename)
+
+        if self.stream or self.manifest or self.backup_store:
+            # Hash (and backup) the file while it is downloaded
+            backup = None
+            if self.stream and not self.backup_store:
+                backup = self.__backup_dir(BACKUP_PATH, filename)
+            digest = sftp.sftp_get_file_md5(filename, self.temp, backup)
+            if not digest:
+                return False
+            self.digests[self.temp + filename] = digest
+        elif not sftp.sftp_get_file(filename, self.temp):
+            return False
+        self.metrics.add('download', size=os.path.getsize(self.temp + filename),
+                         files=1)
+
+        # Backup new files
+        if self.backup_store:
+            self.__store_backup(filename, digest, BACKUP_PATH)
+        elif not self.stream:
+            self.__backup_file(filename, BACKUP_PATH)
+
+        if self.manifest:
+            self.sources[self.temp + filename] = key
+            self.manifest.mark(key, 'downloaded', self.queue,
+                               digest=digest, local_path=self.temp + filename)
+            if self.manifest.delivered(digest, key):
+                logging.info(
+                    '%s %s was re-uploaded with delivered content, skipping it',
+                    self.queue, filename)
+                self.__delete_file(self.temp + filename)
+                self.__mark(self.temp + filename, 'uploaded')
+
+        return self.__remove_file(sftp, filename)
+
+    def __remove_file(self, sftp, filename):
+        '''
+        This function delete file from SFTP Server
+        '''
+        # Hash it if you want to keep them.
+        if not sftp.sftp_remove_file(filename):
+            return False
+        return self.__mark(self.temp + filename, 'removed')
+
+    def __mark(self, filename, stage):
+        '''
+        This function record stage of a local file in the manifest
+        '''
+        if filename in self.sources:
+            self.manifest.mark(self.sources[filename], stage, self.queue)
+            # md5 file is done together with its archive
+            sidecar = filename.split('.tar.bz2')[0] + '.md5'
+            if stage == 'uploaded' and sidecar != filename and \
+                    sidecar in self.sources:
+                self.manifest.mark(self.sources[sidecar], stage, self.queue)
+        return True
+
+    def __owned(self, entry):
+        '''
+        This function check if manifest entry belongs to another
+        run which is still going on
+        '''
+        return entry['queue'] != self.queue and \
+            self.manifest.alive(entry['queue'])
+
+    def __adopt(self, entry):
         '''
-        This function check md5 from file and return string.
+        This function move file of an interrupted run into temp dir.
+        Return False when the file is gone or its run is still going on.
         '''
-        logging.info('%s check_md5() for %s', self.queue, filename)
+        if self.__owned(entry):
+            return False
+        local_path = entry['local_path']
+        if not local_path or not os.path.exists(local_path):
+            return False
+        filename = self.temp + posixpath.basename(entry['remote_path'])
+        logging.info(
+            '%s resuming %s from %s', self.queue, filename, local_path)
         try:
-            with open(filename, 'rb') as f:
-                m = hashlib.md5()
-                while True:
-                    data = f.read(8192)
-                    if not data:
-                        break
-                    m.update(data)
-                return m.hexdigest()
+            if local_path != filename:
+                os.rename(local_path, filename)
         except Exception as error:
             logging.info(
-                "%s Cannot check_md5 on %s error: %s",
-                self.queue, filename, error)
+                "%s Cannot resume %s error: %s",
+                self.queue, local_path, error)
+            return False
+        key = (entry['remote_path'], entry['size'], entry['mtime'])
+        self.sources[filename] = key
+        if entry['digest']:
+            self.digests[filename] = entry['digest']
+        self.manifest.mark(key, 'downloaded', self.queue, local_path=filename)
+        return True
+
+    def __resume(self, directory):
+        '''
+        This function take over downloaded files which are gone from
+        the server but were never uploaded. Return True if any.
+        '''
+        if not self.manifest:
+            return False
+        resumed = False
+        for entry in self.manifest.pending(directory, self.file_type,
+                                           self.regex):
+            if self.__adopt(entry):
+                resumed = True
+        return resumed
+
+    def __upload_nodeone(self, sftp, filename):
+        '''
+        This function upload uncompressed file to nodeone
+        '''
+        logging.info(
+            '%s Uploading file: %s to nodeone SFTP server',
+            self.queue, filename)
+        if not sftp.sftp_upload_file(self.temp_uncompress + filename,
+                                     self.nodeone_remote_path + filename):
+            return False
+        self.metrics.add('upload', files=1,
+                         size=os.path.getsize(self.temp_uncompress + filename))
+        return True
+
+    def __upload_nodetwo(self, sftp, filename):
+        '''
+        This function upload file/report to nodetwo
+        '''
+        logging.info(
+            '%s Uploading file: %s to: %s',
+            self.queue, filename, self.nodetwo_remote_path)
+        if not sftp.sftp_upload_file(self.temp + filename,
+                                     self.nodetwo_remote_path + filename):
+            return False
+        self.metrics.add('upload', files=1,
+                         size=os.path.getsize(self.temp + filename))
+        return self.__mark(self.temp + filename, 'uploaded')
 
-    def __read_md5(self, filename):
+    def __hash_files(self, filenames):
         '''
-        This function read md5 sum from file and return string.
+        This function compute all checksums of files, one file per
+        process. Return {filename: {algorithm: hexdigest}}.
         '''
-        logging.info('%s read_md5() for %s', self.queue, filename)
-        localfile = filename.split('.tar.bz2')[0] + '.md5'
-        if os.path.exists(localfile):
+        digests = {}
+        jobs = []
+        for i in filenames:
+            if all(j in self.hashes.get(i, {}) for j in self.checksums):
+                # computed already while packing
+                digests[i] = self.hashes[i]
+            elif self.checksums == ['md5'] and i in self.digests:
+                # computed already while downloading
+                digests[i] = {'md5': self.digests[i]}
+            else:
+                logging.info('%s check_md5() for %s', self.queue, i)
+                jobs.append((i, self.checksums))
+        if self.processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(self.processes, len(jobs)))
             try:
-                with open(localfile, 'r') as f:
-                    return f.read().split(' ')[0].rstrip()
-            except Exception as error:
+                results = pool.map(hash_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [hash_job(job) for job in jobs]
+        for filename, result, error in results:
+            if error:
                 logging.info(
-                    "%s Cannot read_md5 on %s error: %s",
+                    "%s Cannot check_md5 on %s error: %s",
                     self.queue, filename, error)
-        else:
-            logging.info(
-                '%s read_md5() for %s - No md5 file!',
-                self.queue, localfile)
-            return False
+                self.metrics.add('checksum', failures=1)
+            else:
+                digests[filename] = result
+                self.metrics.add('checksum', files=1,
+                                 size=os.path.getsize(filename))
+        return digests
 
-    def __compare_md5(self, filename):
+    def __verify_uncompress(self):
         '''
-        This function compare md5 sum and return True or False
+        This function check md5 sum of downloaded files and uncompress
+        them, one file per process. Return list of verified files.
         '''
-        if 'md5' not in filename:
-            logging.info('%s compare_md5() for %s', self.queue, filename)
-            if self.__check_md5(filename) == self.__read_md5(filename):
+        jobs = []
+        batch = {}
+        for root, dirs, files in os.walk(self.temp):
+            # checksums from batch files, sidecar files are read by workers
+            for i in files:
+                algorithm = checksum_algorithm(i)
+                if algorithm:
+                    try:
+                        for name, digest in read_checksum_file(self.temp + i).items():
+                            batch[name] = (algorithm, digest)
+                    except Exception as error:
+                        logging.info(
+                            "%s Cannot read checksums from %s error: %s",
+                            self.queue, i, error)
+            for i in files:
+                if not checksum_algorithm(i):
+                    logging.info('%s compare_md5() for %s', self.queue, self.temp + i)
+                    jobs.append((self.temp + i,
+                                 self.digests.get(self.temp + i),
+                                 None if self.stream_extract else self.temp_uncompress,
+                                 batch.get(i)))
+        if self.processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(self.processes, len(jobs)))
+            try:
+                results = pool.map(verify_uncompress, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [verify_uncompress(job) for job in jobs]
+
+        verified = []
+        for filename, result, error, seconds in results:
+            size = os.path.getsize(filename) if os.path.exists(filename) else 0
+            self.metrics.add('md5', seconds=seconds['md5'], size=size,
+                             files=1, failures=0 if result else 1)
+            if seconds['extract']:
+                self.metrics.add('extract', seconds=seconds['extract'],
+                                 size=size, files=1,
+                                 failures=1 if error else 0)
+            if error:
+                logging.info(
+                    "%s Cannot verify or uncompress file: %s error: %s",
+                    self.queue, filename, error)
+            if result:
                 logging.info(
                     '%s check_md5 == read_md5 (%s)',
                     self.queue, filename)
-                return True
+                verified.append(os.path.basename(filename))
+                self.__mark(filename, 'verified')
+                if not error and not self.stream_extract:
+                    self.extracted.append(os.path.basename(filename))
+                    self.__mark(filename, 'extracted')
             else:
                 logging.info(
                     '%s check_md5 != read_md5 (%s)',
                     self.queue, filename)
-                return False
+        return verified
 
-    def __uncompress(self, filename):
+    def __uncompress_upload(self, sftp, filename):
         '''
-        This function uncompress compressed files
+        This function read compressed file as a stream and upload
+        every member to nodeone as soon as it is uncompressed.
+        OB files are uploaded as Traveller copy too.
         '''
-        logging.info('%s uncompress() for %s', self.queue, filename)
-        if tarfile.is_tarfile(filename):
-            try:
-                tar = tarfile.open(filename)
-                tar.extractall(self.temp_uncompress)
-                tar.close()
-            except Exception as error:
+        logging.info('%s uncompress_upload() for %s', self.queue, filename)
+        if not tarfile.is_tarfile(self.temp + filename):
+            logging.info("%s No such file: %s", self.queue, filename)
+            return False
+        result = True
+        try:
+            tar = open_archive(self.temp + filename)
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = os.path.basename(member.name)
+                targets = [(self.nodeone_remote_path + name, None)]
+                newfile = name.replace('OB', 'Traveller_Userlist')
+                # with no OB in the name both copies would be one file
+                if self.file_type.startswith('OB') and newfile != name:
+                    logging.info('%s convert %s to %s', self.queue, name, newfile)
+                    targets.append((self.nodeone_remote_path + newfile,
+                                    ('OB', 'Traveller_Userlist')))
                 logging.info(
-                    "%s Cannot uncompress file: %s error: %s",
-                    self.queue, filename, error)
-        else:
-            logging.info("%s No such file: %s", self.queue, filename, error)
+                    '%s Uploading file: %s to nodeone SFTP server',
+                    self.queue, name)
+                if not sftp.sftp_upload_stream(tar.extractfile(member), targets):
+                    result = False
+                else:
+                    self.metrics.add('extract_upload', files=len(targets),
+                                     size=member.size * len(targets))
+            tar.close()
+        except Exception as error:
+            logging.info(
+                "%s Cannot uncompress file: %s error: %s",
+                self.queue, filename, error)
             return False
+        if result:
+            self.__mark(self.temp + filename, 'extracted')
+            self.__mark(self.temp + filename, 'uploaded')
+        return result
 
     def __ob_to_traveller(self):
         '''
         This function do the copy of OB file to Traveller"
         '''
         logging.info('%s ob_to_traveller()', self.queue)
-        for root, dirs, files in os.walk(self.temp_uncompress):
+        files = []
+        for root, dirs, names in os.walk(self.temp_uncompress):
+            files.extend(names)
+        if not files:
+            return
+        pool = ThreadPool(min(len(files), max(1, self.workers)))
+        try:
+            pool.map(self.__convert_ob, files)
+        finally:
+            pool.close()
+            pool.join()
+
+    def __convert_ob(self, filename):
+        '''
+        This function write Traveller copy of one OB file in one pass,
+        only the first line is rewritten, the rest is copied as it is.
+        '''
+        newfile = filename.replace('OB', 'Traveller_Userlist')
+        if newfile == filename:
+            # writing it would truncate the source before the copy
+            logging.info('%s skip convert of %s, no OB in the name',
+                         self.queue, filename)
+            return
+        part = self.temp_uncompress + newfile + '.part'
+        try:
+            logging.info('%s convert %s to %s', self.queue, filename, newfile)
+            with open(self.temp_uncompress + filename, 'rb') as fin:
+                header = fin.readline(CHUNK_SIZE)
+                with open(part, 'wb') as fout:
+                    fout.write(header.replace('OB', 'Traveller_Userlist'))
+                    if hasattr(os, 'sendfile'):
+                        # let the kernel copy the rest
+                        fout.flush()
+                        offset = len(header)
+                        size = os.fstat(fin.fileno()).st_size
+                        while offset < size:
+                            sent = os.sendfile(fout.fileno(), fin.fileno(),
+                                               offset, size - offset)
+                            if not sent:
+                                break
+                            offset += sent
+                    else:
+                        shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+            shutil.copystat(self.temp_uncompress + filename, part)
+            os.rename(part, self.temp_uncompress + newfile)
+            self.metrics.add('convert', files=1, size=os.path.getsize(
+                self.temp_uncompress + newfile))
+        except Exception as error:
+            logging.info(
+                "%s Cannot ob_to_traveller(), error %s",
+                self.queue, error)
+            self.metrics.add('convert', failures=1)
+            if os.path.exists(part):
+                os.remove(part)
+
+    def __package_files(self):
+        '''
+        This function pack every report into tar archive compressed
+        by blocks on all processes.
+        '''
+        files = []
+        for root, dirs, names in os.walk(self.temp):
+            files.extend(i for i in names if not checksum_algorithm(i))
+        pool = None
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+        try:
             for i in files:
+                self.__package_file(pool, i)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def __package_file(self, pool, filename):
+        '''
+        This function write <name>.tar.bz2 (or .tar.xz) of one report,
+        checksums are computed from compressed blocks as they are
+        written. The report is replaced by the archive.
+        '''
+        archive = "%s%s.tar.%s" % (self.temp, filename.split('.csv')[0],
+                                   self.package)
+        logging.info('%s package() %s', self.queue, archive)
+        hashes = [(i, hashlib.new(i)) for i in self.checksums]
+        blocks = tar_blocks(self.temp + filename, filename)
+        jobs = []
+        try:
+            with open(archive, 'wb') as f:
+                while True:
+                    # keep few blocks in flight, not the whole file
+                    for data in blocks:
+                        job = (self.package, data)
+                        if pool:
+                            jobs.append(pool.apply_async(compress_block, (job,)))
+                        else:
+                            jobs.append(compress_block(job))
+                        if len(jobs) >= 2 * self.processes:
+                            break
+                    if not jobs:
+                        break
+                    data = jobs.pop(0)
+                    if pool:
+                        data = data.get()
+                    f.write(data)
+                    for name, h in hashes:
+                        h.update(data)
+        except Exception as error:
+            logging.info(
+                "%s Cannot package file: %s error: %s",
+                self.queue, filename, error)
+            self.__delete_file(archive)
+            self.metrics.add('package', failures=1)
+            return False
+        self.metrics.add('package', files=1,
+                         size=os.path.getsize(self.temp + filename))
+        self.hashes[archive] = dict((name, h.hexdigest()) for name, h in hashes)
+        if self.temp + filename in self.sources:
+            self.sources[archive] = self.sources.pop(self.temp + filename)
+        self.__delete_file(self.temp + filename)
+        return True
+
+    def __create_checksums(self):
+        '''
+        This function create md5 sum (and other checksums) for files,
+        in one sidecar file per file and algorithm or, with
+        batch_checksums, in one file per algorithm for all of them.
+        '''
+        files = []
+        for root, dirs, names in os.walk(self.temp):
+            files.extend(self.temp + i for i in names
+                         if not checksum_algorithm(i))
+        digests = self.__hash_files(files)
+
+        if self.batch_checksums:
+            for algorithm in self.checksums:
+                localfile = "%sCHECKSUMS_%s.%s" % (self.temp, self.queue, algorithm)
+                logging.info('%s create_md5() %s', self.queue, localfile)
                 try:
-                    newfile = i.replace('OB', 'Traveller_Userlist')
-                    logging.info('%s convert %s to %s', self.queue, i, newfile)
-                    shutil.copy2(self.temp_uncompress + i, self.temp_uncompress + newfile)
-                    with open(self.temp_uncompress + newfile) as fin:
-                        lines = fin.readlines()
-                    lines[0] = lines[0].replace('OB', 'Traveller_Userlist')
-                    with open(self.temp_uncompress + newfile, 'w') as fout:
-                        for line in lines:
-                            fout.write(line)
+                    with open(localfile, 'w') as f:
+                        for i in sorted(digests):
+                            f.write("%s  %s\n" % (digests[i][algorithm],
+                                                  os.path.basename(i)))
                 except Exception as error:
                     logging.info(
-                        "%s Cannot ob_to_traveller(), error %s",
-                        self.queue, error)
+                        "%s Cannot save md5 to file: %s, %s",
+                        self.queue, localfile, error)
+            return
 
-    def __create_md5(self, filename):
-        '''
-        This function create md5 sum from file.
-        '''
-        logging.info('%s create_md5() for %s', self.queue, filename)
-        if 'md5' not in filename:
-            localfile = filename.split('.csv')[0] + '.md5'
-            md5_content = self.__check_md5(filename) + " " + filename + "\n"
-            if os.path.exists(localfile):
-                return False
-            else:
+        for filename in sorted(digests):
+            logging.info('%s create_md5() for %s', self.queue, filename)
+            for algorithm in self.checksums:
+                localfile = filename.split('.csv')[0].split('.tar.')[0] + \
+                    '.' + algorithm
+                content = digests[filename][algorithm] + " " + filename + "\n"
+                if os.path.exists(localfile):
+                    continue
                 try:
                     with open(localfile, 'w') as f:
-                        write_data = f.write(md5_content)
+                        f.write(content)
                 except Exception as error:
                     logging.info(
                         "%s Cannot save md5 to file: %s, %s",
@@ -304,13 +1142,7 @@ class Files(object):
         '''
         This function create backup files
         '''
-        date_now = datetime.datetime.now().strftime("%Y-%m-%d_%H_%M")
-        archive_dir = backup_path + date_now
-        logging.info(
-            '%s backup_file() %s in %s',
-            self.queue, filename, archive_dir)
-        archive_dir = backup_path + date_now
-        self.temp_dir(archive_dir)
+        archive_dir = self.__backup_dir(backup_path, filename)
         try:
             shutil.copy2(self.temp + filename, archive_dir + "/" + filename)
         except Exception as error:
@@ -318,6 +1150,41 @@ class Files(object):
                 "%s Cannot copy file: %s, %s error: %s",
                 self.queue, filename, archive_dir, error)
 
+    def __store_backup(self, filename, digest, backup_path):
+        '''
+        This function keep every content once in backup store
+        and link it into backup directory for now
+        '''
+        archive_dir = self.__backup_dir(backup_path, filename)
+        blob = backup_path + BACKUP_STORE + digest[:2] + "/" + digest
+        try:
+            self.temp_dir(os.path.dirname(blob))
+            if os.path.exists(blob):
+                logging.info(
+                    '%s backup of %s is stored already as %s',
+                    self.queue, filename, digest)
+            else:
+                self.link_file(self.temp + filename, blob)
+            if os.path.exists(archive_dir + "/" + filename):
+                os.remove(archive_dir + "/" + filename)
+            self.link_file(blob, archive_dir + "/" + filename)
+        except Exception as error:
+            logging.info(
+                "%s Cannot store file: %s, %s error: %s",
+                self.queue, filename, archive_dir, error)
+
+    def __backup_dir(self, backup_path, filename):
+        '''
+        This function create and return backup directory for now
+        '''
+        date_now = datetime.datetime.now().strftime(BACKUP_FORMAT)
+        archive_dir = backup_path + date_now
+        logging.info(
+            '%s backup_file() %s in %s',
+            self.queue, filename, archive_dir)
+        self.temp_dir(archive_dir)
+        return archive_dir
+
     def __delete_file(self, filename):
         '''
         This function delete file
@@ -343,6 +1210,42 @@ class Files(object):
         except Exception as error:
             logging.info("Cannot generate random string: %s", error)
 
+    @staticmethod
+    def link_file(source, destination):
+        '''
+        This function hardlink file, or copy it when it is not possible
+        '''
+        try:
+            os.link(source, destination)
+        except OSError as error:
+            if error.errno == errno.EEXIST:
+                return False
+            shutil.copy2(source, destination + '.part')
+            os.rename(destination + '.part', destination)
+        return True
+
+    @staticmethod
+    def prune_backups(backup_path, days):
+        '''
+        This function remove backup directories older than days and
+        stored files which are not linked from any directory anymore.
+        '''
+        limit = datetime.datetime.now() - datetime.timedelta(days=days)
+        for i in sorted(os.listdir(backup_path)):
+            try:
+                date = datetime.datetime.strptime(i, BACKUP_FORMAT)
+            except ValueError:
+                continue
+            if date < limit:
+                logging.info('prune_backups() removing %s%s', backup_path, i)
+                shutil.rmtree(backup_path + i)
+        for root, dirs, files in os.walk(backup_path + BACKUP_STORE):
+            for i in files:
+                blob = os.path.join(root, i)
+                if os.stat(blob).st_nlink == 1:
+                    logging.info('prune_backups() removing %s', blob)
+                    os.remove(blob)
+
     @staticmethod
     def temp_dir(temp="temp"):
         """
@@ -369,48 +1272,281 @@ class SFTPConnect(object):
     '''
     SFTPConnect will deal with connection to SFTP server.
     '''
+    # directory snapshots of all sessions:
+    # (host, port, directory) -> (mtime, settle, attributes)
+    listings = {}
+    lock = threading.Lock()
+
     def __init__(self, ip, username, public_key, queue, port=22):
         ''' init method '''
         self.queue = queue
         self.port = port
         self.hostname = ip
         self.username = username
-        self.transport = paramiko.Transport((self.hostname, self.port))
+        self.directory = None
+        self.throttle = None
 
         try:
             self.key = paramiko.RSAKey.from_private_key_file(public_key)
-            self.transport.connect(username=self.username,
-                                   pkey=self.key)
-            self.sftp = paramiko.SFTP.from_transport(self.transport)
+            self.__connect()
         except Exception as error:
             logging.info(
                 "%s Cannot connect to SFTP server: %s %s %s %s",
                 self.queue, ip, username, public_key, error)
             sys.exit(1)
 
-    def sftp_list_files(self, directory, file_type):
+    def __connect(self):
+        '''
+        This function open transport and sftp session
+        '''
+        self.transport = paramiko.Transport((self.hostname, self.port))
+        self.transport.connect(username=self.username, pkey=self.key)
+        self.transport.set_keepalive(KEEPALIVE)
+        self.sftp = paramiko.SFTP.from_transport(self.transport)
+        if self.directory is not None:
+            self.sftp.chdir(self.directory)
+
+    def sftp_reconnect(self):
+        '''
+        This function open new session when the old one is broken
+        '''
+        logging.info(
+            '%s sftp_reconnect() to %s', self.queue, self.hostname)
+        try:
+            self.sftp.close()
+            self.transport.close()
+        except Exception:
+            pass
+        self.__connect()
+
+    def __retry(self, func, *args):
+        '''
+        This function call func until it works, at most RETRIES times
+        more, with backoff. Broken sessions are opened again.
+        '''
+        delay = RETRY_DELAY
+        for attempt in range(RETRIES + 1):
+            try:
+                return func(*args)
+            except Exception as error:
+                if attempt == RETRIES:
+                    raise
+                logging.info(
+                    "%s %s failed (%s/%s), retrying in %ss. Error: %s",
+                    self.queue, args[0], attempt + 1, RETRIES, delay, error)
+                time.sleep(delay)
+                delay *= 2
+                if not self.transport.is_active():
+                    try:
+                        self.sftp_reconnect()
+                    except Exception as error:
+                        logging.info(
+                            "%s Cannot reconnect. Error: %s",
+                            self.queue, error)
+
+    @staticmethod
+    def __same_prefix(first, second, length):
+        '''
+        This function compare the start and the end of first length
+        bytes of two files.
+        '''
+        for offset in (0, max(0, length - VERIFY_SIZE)):
+            size = min(VERIFY_SIZE, length)
+            first.seek(offset)
+            second.seek(offset)
+            if first.read(size) != second.read(size):
+                return False
+        return True
+
+    def __download(self, filename, local_path, backup_path=None, digest=False):
+        '''
+        This function download file, continuing a partial local file
+        when its prefix is the same as on the server.
+        Return md5 hexdigest when digest is True.
+        '''
+        m = hashlib.md5() if digest else None
+        outputs = []
+        with self.sftp.open(filename, 'rb') as remote:
+            size = remote.stat().st_size
+            offset = 0
+            if os.path.exists(local_path):
+                offset = os.path.getsize(local_path)
+            try:
+                local = open(local_path, 'r+b' if offset else 'wb')
+                outputs.append(local)
+                if offset > size or \
+                        (offset and not self.__same_prefix(local, remote, offset)):
+                    offset = 0
+                if offset:
+                    logging.info(
+                        '%s resuming %s at %s/%s bytes',
+                        self.queue, filename, offset, size)
+                if backup_path:
+                    outputs.append(open(backup_path, 'wb'))
+
+                # hash and backup what we have already
+                local.seek(0)
+                done = 0
+                while (m or backup_path) and done < offset:
+                    data = local.read(min(CHUNK_SIZE, offset - done))
+                    done += len(data)
+                    if m:
+                        m.update(data)
+                    for out in outputs[1:]:
+                        out.write(data)
+
+                local.seek(offset)
+                local.truncate()
+                remote.seek(offset)
+                if not self.throttle:
+                    # read ahead everything, unless we read it slowly
+                    remote.prefetch()
+                while True:
+                    data = remote.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    if self.throttle:
+                        self.throttle.consume(len(data))
+                    if m:
+                        m.update(data)
+                    for out in outputs:
+                        out.write(data)
+            finally:
+                for out in outputs:
+                    out.close()
+        if os.path.getsize(local_path) != size:
+            raise IOError('size mismatch for %s' % filename)
+        return m.hexdigest() if m else True
+
+    def __upload(self, local_path, remote_path):
+        '''
+        This function upload file, continuing a partial remote file
+        when its prefix is the same as the local file.
+        '''
+        size = os.path.getsize(local_path)
+        try:
+            offset = self.sftp.stat(remote_path).st_size
+        except IOError:
+            offset = 0
+        with open(local_path, 'rb') as local:
+            if offset >= size:
+                offset = 0
+            if offset:
+                with self.sftp.open(remote_path, 'rb') as remote:
+                    if not self.__same_prefix(local, remote, offset):
+                        offset = 0
+            if offset:
+                logging.info(
+                    '%s resuming %s at %s/%s bytes',
+                    self.queue, remote_path, offset, size)
+            with self.sftp.open(remote_path, 'r+' if offset else 'w') as remote:
+                remote.set_pipelined(True)
+                remote.seek(offset)
+                local.seek(offset)
+                while True:
+                    data = local.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    if self.throttle:
+                        self.throttle.consume(len(data))
+                    remote.write(data)
+        if self.sftp.stat(remote_path).st_size != size:
+            raise IOError('size mismatch for %s' % remote_path)
+        return True
+
+    def sftp_chdir(self, directory):
+        '''
+        This function change remote working directory.
+        '''
+        if self.directory != directory:
+            self.sftp.chdir(directory)
+            self.directory = directory
+
+    def sftp_list_files(self, directory, file_type, required=True):
         '''
         This function get a list of files.
+        Exit when there is no such file and it is required.
+        '''
+        for i in self.sftp_list_attr(directory, file_type, required):
+            yield i.filename
+
+    def sftp_list_attr(self, directory, file_type, required=True,
+                       min_age=0, regex=False):
+        '''
+        This function get a list of files with their attributes.
+        file_type: prefix, glob (with * ? or [) or regex of file names
+        min_age: skip files modified less than min_age seconds ago,
+        they can be still uploaded
+        Exit when there is no such file and it is required.
         '''
         logging.info(
-            '%s sftp_list_files() %s%s',
+            '%s sftp_list_attr() %s%s',
             self.queue, directory, file_type)
-        count = True
+        files = []
         try:
-            self.sftp.chdir(directory)
+            self.sftp_chdir(directory)
+            listing = self.__listdir_attr(directory, min_age)
         except Exception as error:
             logging.info(
                 "%s Failed to list files in %s, error: %s",
                 self.queue, directory, error)
-        else:
-            for i in self.sftp.listdir():
-                if i.startswith(file_type):
-                    count = False
-                    yield i
-            if count:
-                logging.info("%s sftp_list_files() No such file: %s%s",
-                             self.queue, directory, file_type)
+            return files
+        now = time.time()
+        for i in listing:
+            if not stat.S_ISREG(i.st_mode or 0) or \
+                    not match_file(i.filename, file_type, regex):
+                continue
+            if now - i.st_mtime < min_age:
+                logging.info(
+                    '%s sftp_list_attr() skipping %s, modified %ds ago',
+                    self.queue, i.filename, now - i.st_mtime)
+                continue
+            files.append(i)
+        if not files:
+            logging.info("%s sftp_list_files() No such file: %s%s",
+                         self.queue, directory, file_type)
+            if required:
                 sys.exit(1)
+        return files
+
+    def __listdir_attr(self, directory, min_age):
+        '''
+        This function return attributes of files in the current
+        directory. Snapshot of the directory is reused while its mtime
+        does not change and all its files were already settled when
+        it was taken.
+        '''
+        key = (self.hostname, self.port, directory)
+        settle = max(min_age, 1)
+        mtime = self.sftp.stat('.').st_mtime
+        with SFTPConnect.lock:
+            snapshot = SFTPConnect.listings.get(key)
+        if snapshot and snapshot[0] == mtime and snapshot[1] >= settle:
+            logging.info(
+                '%s sftp_list_attr() %s did not change', self.queue, directory)
+            return snapshot[2]
+        now = time.time()
+        listing = self.sftp.listdir_attr()
+        with SFTPConnect.lock:
+            if now - mtime > 1 and \
+                    all(now - i.st_mtime > settle for i in listing):
+                SFTPConnect.listings[key] = (mtime, settle, listing)
+            else:
+                SFTPConnect.listings.pop(key, None)
+        return listing
+
+    def sftp_stat(self, filename):
+        '''
+        This function return (size, mtime) of remote file
+        '''
+        try:
+            attr = self.sftp.stat(filename)
+        except Exception as error:
+            logging.info(
+                "%s Cannot sftp_stat(): %s. Error: %s",
+                self.queue, filename, error)
+            return (None, None)
+        return (attr.st_size, attr.st_mtime)
 
     def sftp_get_file(self, filename, local_dir):
         '''
@@ -420,16 +1556,37 @@ class SFTPConnect(object):
             '%s sftp_get_file() downloading: %s%s',
             self.queue, local_dir, filename)
         try:
-            if os.path.exists(local_dir):
-                self.sftp.get(filename, local_dir+filename)
-            else:
+            if not os.path.exists(local_dir):
                 # temp_dir(local_dir)
                 Files.temp_dir(local_dir)
-                self.sftp.get(filename, local_dir+filename)
+            self.__retry(self.__download, filename, local_dir+filename)
         except Exception as error:
             logging.info(
                 "%s Cannot sftp_get_file(): %s. Error: %s",
                 self.queue, filename, error)
+            return False
+        return True
+
+    def sftp_get_file_md5(self, filename, local_dir, backup_dir=None):
+        '''
+        This function download file and compute its md5 on the way.
+        When backup_dir is given the same bytes are written there too.
+        Return md5 hexdigest or False.
+        '''
+        logging.info(
+            '%s sftp_get_file_md5() downloading: %s%s',
+            self.queue, local_dir, filename)
+        try:
+            if not os.path.exists(local_dir):
+                Files.temp_dir(local_dir)
+            return self.__retry(
+                self.__download, filename, local_dir + filename,
+                backup_dir and backup_dir + "/" + filename, True)
+        except Exception as error:
+            logging.info(
+                "%s Cannot sftp_get_file_md5(): %s. Error: %s",
+                self.queue, filename, error)
+            return False
 
     def sftp_upload_file(self, local_path, remote_path):
         '''
@@ -439,11 +1596,80 @@ class SFTPConnect(object):
             '%s sftp_upload_file() %s %s',
             self.queue, local_path, remote_path)
         try:
-            self.sftp.put(local_path, remote_path)
+            self.__retry(self.__upload, local_path, remote_path)
         except Exception as error:
             logging.info(
                 "%s Problem with local: %s or remote %s path. Error: %s",
                 self.queue, local_path, remote_path, error)
+            return False
+        return True
+
+    def sftp_upload_stream(self, fileobj, targets):
+        '''
+        This function upload file object to remote paths.
+        Reading fileobj and writing to the server overlap through
+        a buffer of INFLIGHT_CHUNKS chunks, so memory use is constant.
+        targets: list of (remote_path, replace), replace is None or
+        (old, new) to be replaced in the first line of that copy.
+        '''
+        logging.info(
+            '%s sftp_upload_stream() %s',
+            self.queue, ', '.join(path for path, replace in targets))
+        chunks = Queue.Queue(INFLIGHT_CHUNKS)
+        errors = []
+
+        def writer():
+            ''' write chunks to every target until None '''
+            remotes = []
+            try:
+                for path, replace in targets:
+                    remote = self.sftp.open(path, 'wb')
+                    remote.set_pipelined(True)
+                    remotes.append((remote, replace))
+                first = True
+                while True:
+                    data = chunks.get()
+                    if data is None:
+                        break
+                    if self.throttle:
+                        self.throttle.consume(len(data) * len(remotes))
+                    for remote, replace in remotes:
+                        if first and replace:
+                            remote.write(data.replace(*replace))
+                        else:
+                            remote.write(data)
+                    first = False
+            except Exception as error:
+                errors.append(error)
+                # keep draining so the reader never blocks
+                while chunks.get() is not None:
+                    pass
+            finally:
+                for remote, replace in remotes:
+                    remote.close()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            # first chunk is the first line, it may be rewritten,
+            # a file without new lines is not read into memory at once
+            chunks.put(fileobj.readline(CHUNK_SIZE))
+            while not errors:
+                data = fileobj.read(CHUNK_SIZE)
+                if not data:
+                    break
+                chunks.put(data)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            chunks.put(None)
+            thread.join()
+        if errors:
+            logging.info(
+                "%s Cannot sftp_upload_stream() to %s. Error: %s",
+                self.queue, targets[0][0], errors[0])
+            return False
+        return True
 
     def sftp_remove_file(self, filename):
         '''
@@ -454,6 +1680,8 @@ class SFTPConnect(object):
             self.sftp.remove(filename)
         except Exception as error:
             logging.info("%s queue, error: %s", self.queue, error)
+            return False
+        return True
 
     def sftp_close(self):
         '''
@@ -461,11 +1689,549 @@ class SFTPConnect(object):
         '''
         try:
             self.sftp.close()
+            self.transport.close()
         except Exception as error:
             logging.info(
                 "%s Cannot close connection. Error: %s",
                 self.queue, error)
 
+
+class SFTPPool(object):
+    '''
+    SFTPPool is a transfer engine on top of SFTPConnect.
+    It keeps a bounded pool of SFTP sessions to one host and runs
+    transfers concurrently, one session per worker.
+    Sessions are kept alive, so the pool can be reused between runs.
+    :param size: maximum number of sessions/workers for this host
+    :param throttle: Throttle shared by all sessions or None
+    '''
+    def __init__(self, ip, username, public_key, queue, port=22, size=1,
+                 throttle=None):
+        ''' init method, opens the first session '''
+        self.queue = queue
+        self.settings = (ip, username, public_key, queue, port)
+        self.size = max(1, int(size))
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.idle = Queue.Queue()
+        self.grow(1)
+
+    def grow(self, count):
+        '''
+        This function open new sessions until there is count of them.
+        SFTPConnect exits when it cannot connect.
+        '''
+        with self.lock:
+            while len(self.sessions) < min(count, self.size):
+                logging.info(
+                    '%s SFTPPool opening session %s/%s to %s',
+                    self.queue, len(self.sessions) + 1, self.size,
+                    self.settings[0])
+                session = SFTPConnect(*self.settings)
+                session.throttle = self.throttle
+                self.sessions.append(session)
+                self.idle.put(session)
+
+    def acquire(self, directory=None, queue=None):
+        '''
+        This function take idle session from the pool, open it again
+        when it is broken and change its directory when needed.
+        '''
+        session = self.idle.get()
+        try:
+            if queue is not None:
+                session.queue = queue
+            if not session.transport.is_active():
+                session.sftp_reconnect()
+            if directory is not None:
+                session.sftp_chdir(directory)
+        except Exception:
+            self.idle.put(session)
+            raise
+        return session
+
+    def release(self, session):
+        '''
+        This function give session back to the pool
+        '''
+        self.idle.put(session)
+
+    def sftp_list_attr(self, directory, file_type, required=True,
+                       min_age=0, regex=False, queue=None):
+        '''
+        This function get a list of files with their attributes.
+        '''
+        session = self.acquire(directory, queue)
+        try:
+            return session.sftp_list_attr(directory, file_type, required,
+                                          min_age, regex)
+        finally:
+            self.release(session)
+
+    def run(self, func, items, directory=None, queue=None):
+        '''
+        This function run func(session, item) for every item
+        using up to size workers and return list of results.
+        directory: remote directory the sessions work in
+        queue: queue ID used in logs, the pool's one by default
+        '''
+        queue = queue or self.queue
+        items = list(items)
+        if not items:
+            return []
+        workers = min(len(items), self.size)
+        self.grow(workers)
+
+        def job(item):
+            ''' single transfer on a pooled session '''
+            try:
+                session = self.acquire(directory, queue)
+            except Exception as error:
+                logging.info(
+                    "%s Cannot get SFTP session for %s, error: %s",
+                    queue, item, error)
+                return False
+            try:
+                result = func(session, item)
+            except Exception as error:
+                logging.info(
+                    "%s Transfer of %s failed, error: %s",
+                    queue, item, error)
+                result = False
+            finally:
+                self.release(session)
+            logging.info(
+                '%s %s: %s', queue, item,
+                'done' if result is not False else 'failed')
+            return result
+
+        pool = ThreadPool(workers)
+        try:
+            # one item at a time, so workers follow the order of items
+            return pool.map(job, items, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        '''
+        This function close all sessions of the pool
+        '''
+        for session in self.sessions:
+            session.sftp_close()
+        self.sessions = []
+        self.idle = Queue.Queue()
+
+
+class Throttle(object):
+    '''
+    Throttle will limit bytes per second of all transfers using it.
+    :param rate: bytes per second
+    '''
+    def __init__(self, rate):
+        ''' init method '''
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.allowance = self.rate
+        self.last = time.time()
+
+    def consume(self, size):
+        '''
+        This function wait until size bytes can be sent
+        '''
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance +
+                                 (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Metrics(object):
+    '''
+    Metrics will count duration, bytes, files and failures of every
+    stage of one run. Stages timed in worker processes (md5, extract)
+    have their seconds summed over all processes.
+    :param queue: queue ID of the run
+    :param file_type: type of files of the run
+    '''
+    def __init__(self, queue, file_type):
+        ''' init method '''
+        self.queue = queue
+        self.file_type = file_type
+        self.direction = None
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.seconds = None
+        self.stages = []
+        self.counters = {}
+
+    def add(self, stage, seconds=0.0, size=0, files=0, failures=0):
+        '''
+        This function add numbers to the stage, it is thread safe
+        '''
+        with self.lock:
+            if stage not in self.counters:
+                self.stages.append(stage)
+                self.counters[stage] = {'seconds': 0.0, 'bytes': 0,
+                                        'files': 0, 'failures': 0}
+            counter = self.counters[stage]
+            counter['seconds'] += seconds
+            counter['bytes'] += size
+            counter['files'] += files
+            counter['failures'] += failures
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        '''
+        This function add time spent in with block to the stage
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, seconds=time.time() - start)
+
+    def finish(self):
+        '''
+        This function stop the clock of the run
+        '''
+        self.seconds = time.time() - self.started
+
+    def report(self):
+        '''
+        This function return metrics of the run as a dict
+        '''
+        stages = []
+        with self.lock:
+            for stage in self.stages:
+                counter = dict(self.counters[stage], stage=stage)
+                counter['mb_per_second'] = 0.0
+                if counter['seconds'] > 0:
+                    counter['mb_per_second'] = round(
+                        counter['bytes'] / 1048576.0 / counter['seconds'], 3)
+                stages.append(counter)
+        return {'queue': self.queue,
+                'type': self.file_type,
+                'direction': self.direction,
+                'started': datetime.datetime.fromtimestamp(
+                    self.started).strftime('%Y-%m-%d %H:%M:%S'),
+                'seconds': self.seconds,
+                'failures': sum(i['failures'] for i in stages),
+                'stages': stages}
+
+    def save_json(self, directory):
+        '''
+        This function save JSON report to directory/report_<queue>.json
+        '''
+        filename = os.path.join(directory, 'report_%s.json' % self.queue)
+        try:
+            with open(filename, 'w') as f:
+                json.dump(self.report(), f, indent=2, sort_keys=True)
+            logging.info('%s Report saved to %s', self.queue, filename)
+        except Exception as error:
+            logging.info(
+                "%s Cannot save report: %s error: %s",
+                self.queue, filename, error)
+
+    @staticmethod
+    def label(value):
+        '''
+        This function escape label value for Prometheus text format
+        '''
+        return str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+
+    def save_prometheus(self, directory):
+        '''
+        This function save metrics of the run for node_exporter
+        textfile collector, one file per type and direction which
+        is replaced atomically every run.
+        '''
+        report = self.report()
+        labels = 'type="%s",direction="%s"' % (
+            self.label(self.file_type), self.label(self.direction))
+        lines = []
+        for name, key, text in (
+                ('seconds', 'seconds', 'Seconds spent in stage'),
+                ('bytes', 'bytes', 'Bytes processed in stage'),
+                ('files', 'files', 'Files processed in stage'),
+                ('failures', 'failures', 'Failed files in stage')):
+            metric = 'filemd5checktransfer_stage_%s' % name
+            lines.append('# HELP %s %s of the last run' % (metric, text))
+            lines.append('# TYPE %s gauge' % metric)
+            for stage in report['stages']:
+                lines.append('%s{%s,stage="%s"} %s' % (
+                    metric, labels, stage['stage'], stage[key]))
+        lines.append('# HELP filemd5checktransfer_run_seconds '
+                     'Duration of the last run')
+        lines.append('# TYPE filemd5checktransfer_run_seconds gauge')
+        lines.append('filemd5checktransfer_run_seconds{%s} %s' % (
+            labels, report['seconds']))
+        lines.append('# HELP filemd5checktransfer_last_run_timestamp_seconds '
+                     'Start of the last run')
+        lines.append('# TYPE filemd5checktransfer_last_run_timestamp_seconds '
+                     'gauge')
+        lines.append('filemd5checktransfer_last_run_timestamp_seconds{%s} %s' % (
+            labels, self.started))
+        # glob and regex types are not file names
+        filename = os.path.join(directory, 'filemd5checktransfer_%s_%s.prom' % (
+            re.sub(r'[^A-Za-z0-9_]', '_', self.file_type),
+            re.sub(r'[^A-Za-z0-9_]', '_', self.direction)))
+        try:
+            with open(filename + '.' + self.queue, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.rename(filename + '.' + self.queue, filename)
+        except Exception as error:
+            logging.info(
+                "%s Cannot save metrics: %s error: %s",
+                self.queue, filename, error)
+
+
+class Daemon(object):
+    '''
+    Daemon will run jobs from config file forever, reusing SFTP
+    sessions between runs instead of connecting every time.
+    Jobs working on the same remote directory never overlap.
+    :param config: JSON file with list of jobs, each of them:
+        {"type": "OB", "destination": "nodetwo", "nodetwo_dir": "/in",
+         "nodeone_dir": "/out/", "interval": 60}
+    :param options: other Files arguments used for every job
+    '''
+    def __init__(self, config, options):
+        ''' init method '''
+        with open(config) as f:
+            self.jobs = json.load(f)
+        self.options = options
+        self.lock = threading.Lock()
+        self.busy = set()
+        self.pools = {}
+        logging.info('Daemon started with %s jobs', len(self.jobs))
+        workers = options.get('workers', WORKERS)
+        throttle = None
+        if options.get('bwlimit'):
+            throttle = Throttle(options['bwlimit'])
+        # both ways download from or upload to nodeone
+        self.pools['nodeone'] = SFTPPool(NODEONE_IP,
+                                         NODEONE_USERNAME,
+                                         NODEONE_PUBLIC_KEY,
+                                         'daemon', NODEONE_PORT,
+                                         options.get('nodeone_workers') or workers,
+                                         throttle)
+        if any(i['destination'] == 'nodeone' for i in self.jobs):
+            self.pools['nodetwo'] = SFTPPool(NODETWO_IP,
+                                             NODETWO_USERNAME,
+                                             NODETWO_PUBLIC_KEY,
+                                             'daemon', NODETWO_PORT,
+                                             options.get('nodetwo_workers') or workers,
+                                             throttle)
+
+    def main(self):
+        ''' main loop, starts every job when it is due '''
+        next_run = [0] * len(self.jobs)
+        while True:
+            for n, job in enumerate(self.jobs):
+                if time.time() >= next_run[n] and self.__claim(job):
+                    next_run[n] = time.time() + job.get('interval', 60)
+                    thread = threading.Thread(target=self.__run, args=(job,))
+                    thread.daemon = True
+                    thread.start()
+            time.sleep(1)
+
+    @staticmethod
+    def __directories(job):
+        ''' remote directories used by the job '''
+        return set([posixpath.normpath(job['nodetwo_dir']),
+                    posixpath.normpath(job['nodeone_dir'])])
+
+    def __claim(self, job):
+        '''
+        This function reserve job directories, return False
+        when another job is working there.
+        '''
+        with self.lock:
+            if self.busy & self.__directories(job):
+                return False
+            self.busy |= self.__directories(job)
+            return True
+
+    def __run(self, job):
+        ''' single run of the job '''
+        run = None
+        try:
+            run = Files(job['type'], job['nodetwo_dir'], job['nodeone_dir'],
+                        pools=self.pools, **self.options)
+            run.main(job['destination'])
+        except SystemExit:
+            # nothing to do this time, drop empty temp directories
+            for i in (run.temp, run.temp_uncompress) if run else ():
+                try:
+                    os.rmdir(i)
+                except OSError:
+                    pass
+        except Exception as error:
+            logging.info(
+                "Daemon job %s %s failed, error: %s",
+                job['type'], job['destination'], error)
+        finally:
+            with self.lock:
+                self.busy -= self.__directories(job)
+
+
+class Manifest(object):
+    '''
+    Manifest will keep track of transferred files in sqlite, so
+    next runs skip what was done already.
+    Every remote file is keyed by its path, size and mtime and
+    has a timestamp for every stage it went through.
+    :param path: path to the sqlite database
+    '''
+    STAGES = ('downloaded', 'verified', 'extracted', 'uploaded', 'removed')
+
+    def __init__(self, path):
+        ''' init method, creates the table when needed '''
+        self.locks = path + '.locks'
+        self.held = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS manifest (
+                   remote_path TEXT, size INTEGER, mtime INTEGER,
+                   digest TEXT, local_path TEXT, queue TEXT,
+                   downloaded TEXT, verified TEXT, extracted TEXT,
+                   uploaded TEXT, removed TEXT,
+                   PRIMARY KEY (remote_path, size, mtime))""")
+            self.conn.execute(
+                """CREATE INDEX IF NOT EXISTS manifest_digest
+                   ON manifest (digest)""")
+
+    def get(self, remote_path, size, mtime):
+        '''
+        This function return manifest entry or None
+        '''
+        with self.lock:
+            return self.conn.execute(
+                """SELECT * FROM manifest WHERE remote_path=?
+                   AND size IS ? AND mtime IS ?""",
+                (remote_path, size, mtime)).fetchone()
+
+    def mark(self, key, stage, queue, **values):
+        '''
+        This function record that file reached the stage.
+        values: optional digest and local_path
+        '''
+        if stage not in self.STAGES:
+            raise ValueError(stage)
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        columns = ['queue', stage] + sorted(values)
+        params = [queue, now] + [values[i] for i in sorted(values)]
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    """INSERT OR IGNORE INTO manifest
+                       (remote_path, size, mtime) VALUES (?, ?, ?)""", key)
+                self.conn.execute(
+                    """UPDATE manifest SET %s WHERE remote_path=?
+                       AND size IS ? AND mtime IS ?""" %
+                    ', '.join(i + '=?' for i in columns),
+                    params + list(key))
+
+    def delivered(self, digest, key):
+        '''
+        This function check if the same content was uploaded already
+        from the same remote path (a re-upload with new mtime).
+        Files with other paths are never duplicates, even with the
+        same content.
+        '''
+        with self.lock:
+            return self.conn.execute(
+                """SELECT 1 FROM manifest WHERE digest=?
+                   AND uploaded IS NOT NULL AND remote_path=?
+                   AND NOT (size IS ? AND mtime IS ?)""",
+                [digest] + list(key)).fetchone() is not None
+
+    def pending(self, directory, file_type, regex=False):
+        '''
+        This function return entries removed from the server
+        but never uploaded.
+        file_type, regex: type of files like in sftp_list_attr()
+        '''
+        prefix = posixpath.normpath(directory).rstrip('/') + '/'
+        with self.lock:
+            # paths in directory sort from prefix to prefix with '/' + 1,
+            # so the primary key is used
+            rows = self.conn.execute(
+                """SELECT * FROM manifest WHERE remote_path >= ?
+                   AND remote_path < ?
+                   AND instr(substr(remote_path, ?), '/') = 0
+                   AND removed IS NOT NULL AND uploaded IS NULL
+                   AND local_path IS NOT NULL""",
+                (prefix, prefix[:-1] + '0', len(prefix) + 1)).fetchall()
+        return [i for i in rows
+                if match_file(posixpath.basename(i['remote_path']),
+                              file_type, regex)]
+
+    def forget(self, directory):
+        '''
+        This function clear local paths under deleted directory,
+        files which were not uploaded from there cannot be resumed
+        '''
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    """UPDATE manifest SET local_path=NULL
+                       WHERE substr(local_path, 1, ?) = ?""",
+                    (len(directory), directory))
+
+    def hold(self, queue):
+        '''
+        This function lock file of the queue until the run ends,
+        other runs do not take over files of a locked queue
+        '''
+        try:
+            os.makedirs(self.locks)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        self.held = open(os.path.join(self.locks, queue), 'w')
+        fcntl.flock(self.held, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def release(self):
+        '''
+        This function unlock and remove lock file of the run
+        '''
+        if self.held:
+            try:
+                os.remove(self.held.name)
+            except OSError:
+                pass
+            self.held.close()
+            self.held = None
+
+    def alive(self, queue):
+        '''
+        This function check if run of the queue is still going on,
+        lock of a run which died is free
+        '''
+        filename = os.path.join(self.locks, queue or '')
+        if not queue or not os.path.exists(filename):
+            return False
+        try:
+            with open(filename, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        return False
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="nodetwo - scheduled task framework - md5 check,"
@@ -480,23 +2246,146 @@ if __name__ == '__main__':
 
     parser.add_argument('-s', '--nodetwo_dir',
                         help='Path for dir in nodetwo server',
-                        required=True)
+                        required=False)
     parser.add_argument('-b', '--nodeone_dir',
                         help='Path for dir in nodeone server',
-                        required=True)
+                        required=False)
     parser.add_argument('-t', '--type',
-                        help='Type of files',
-                        required=True)
+                        help='Type of files: prefix or glob',
+                        required=False)
+    parser.add_argument('--regex', action='store_true',
+                        help='Type of files is a regular expression',
+                        required=False)
+    parser.add_argument('--min-age', type=int, default=0, metavar='SECONDS',
+                        help='Skip files modified less than SECONDS ago',
+                        required=False)
     parser.add_argument('-d', '--destination',
                         help='Destination/way: nodetwo or nodeone',
-                        required=True)
+                        required=False)
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+                        help='Concurrent SFTP transfers per host',
+                        required=False)
+    parser.add_argument('--nodeone-workers', type=int,
+                        help='Concurrent SFTP transfers to nodeone',
+                        required=False)
+    parser.add_argument('--nodetwo-workers', type=int,
+                        help='Concurrent SFTP transfers to nodetwo',
+                        required=False)
+    parser.add_argument('--bwlimit', type=int, default=BWLIMIT,
+                        metavar='BYTES',
+                        help='Bytes per second for all transfers',
+                        required=False)
+    parser.add_argument('--order', default=ORDER,
+                        choices=['listing', 'smallest', 'priority'],
+                        help='Order of transfers',
+                        required=False)
+    parser.add_argument('--priority', metavar='PREFIX=N,...',
+                        help='Priority of file type prefixes, lower first',
+                        required=False)
+    parser.add_argument('--report', default=REPORT_DIR, metavar='DIR',
+                        help='Save JSON run report to this directory',
+                        required=False)
+    parser.add_argument('--prometheus', default=PROMETHEUS_DIR,
+                        metavar='DIR',
+                        help='Save metrics for Prometheus textfile collector',
+                        required=False)
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Run under cProfile and save stats to file',
+                        required=False)
+    parser.add_argument('--package', default=PACKAGE,
+                        choices=['bz2', 'xz'],
+                        help='Pack reports sent to nodetwo as tar.bz2/tar.xz',
+                        required=False)
+    parser.add_argument('--stream', action='store_true',
+                        help='Hash and backup files while downloading',
+                        required=False)
+    parser.add_argument('--stream-extract', action='store_true',
+                        help='Upload archive members while uncompressing',
+                        required=False)
+    parser.add_argument('-p', '--processes', type=int, default=PROCESSES,
+                        help='Processes verifying and uncompressing files',
+                        required=False)
+    parser.add_argument('-m', '--manifest', default=MANIFEST_PATH,
+                        help='Path to the sqlite transfer manifest',
+                        required=False)
+    parser.add_argument('--checksum', default=','.join(CHECKSUMS),
+                        help='Checksums created for reports, e.g. md5,sha256',
+                        required=False)
+    parser.add_argument('--batch-checksums', action='store_true',
+                        help='One checksum file for all reports',
+                        required=False)
+    parser.add_argument('--backup-store', action='store_true',
+                        help='Keep one backup copy per md5 and link to it',
+                        required=False)
+    parser.add_argument('--prune-backups', type=int, metavar='DAYS',
+                        help='Remove backups older than DAYS and exit',
+                        required=False)
+    parser.add_argument('--daemon', metavar='CONFIG',
+                        help='Run jobs from JSON config file forever',
+                        required=False)
 
     args = vars(parser.parse_args())
+    if args['package'] == 'xz' and lzma is None:
+        parser.error('--package xz needs lzma module')
+    priorities = None
+    if args['priority']:
+        priorities = dict((i.split('=')[0], int(i.split('=')[1]))
+                          for i in args['priority'].split(','))
+
+    if args['prune_backups'] is not None:
+        start = Logs()
+        Files.prune_backups(BACKUP_PATH, args['prune_backups'])
+        sys.exit(0)
+
+    if args['daemon']:
+        start = Logs()
+        Daemon(args['daemon'],
+               {'workers': args['workers'],
+                'stream': args['stream'],
+                'stream_extract': args['stream_extract'],
+                'processes': args['processes'],
+                'manifest': args['manifest'],
+                'backup_store': args['backup_store'],
+                'min_age': args['min_age'],
+                'regex': args['regex'],
+                'checksums': args['checksum'].split(','),
+                'batch_checksums': args['batch_checksums'],
+                'order': args['order'],
+                'priorities': priorities,
+                'nodeone_workers': args['nodeone_workers'],
+                'nodetwo_workers': args['nodetwo_workers'],
+                'bwlimit': args['bwlimit'],
+                'report': args['report'],
+                'prometheus': args['prometheus'],
+                'package': args['package']}).main()
+
+    if not (args['nodetwo_dir'] and args['nodeone_dir'] and
+            args['type'] and args['destination']):
+        parser.error('arguments -s, -b, -t and -d are required')
 
     if args['nodetwo_dir'] and args['nodeone_dir']:
         if args['type'] and args['destination']:
             start = Logs()
             run = Files(args['type'],
                         args['nodetwo_dir'],
-                        args['nodeone_dir'])
+                        args['nodeone_dir'],
+                        args['workers'],
+                        args['stream'],
+                        args['stream_extract'],
+                        args['processes'],
+                        args['manifest'],
+                        args['backup_store'],
+                        min_age=args['min_age'],
+                        regex=args['regex'],
+                        checksums=args['checksum'].split(','),
+                        batch_checksums=args['batch_checksums'],
+                        order=args['order'],
+                        priorities=priorities,
+                        nodeone_workers=args['nodeone_workers'],
+                        nodetwo_workers=args['nodetwo_workers'],
+                        bwlimit=args['bwlimit'],
+                        report=args['report'],
+                        prometheus=args['prometheus'],
+                        profile=args['profile'],
+                        package=args['package'])
             run.main(args['destination'])
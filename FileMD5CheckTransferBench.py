@@ -0,0 +1,470 @@
+#!/usr/bin/python
+''' FileMD5CheckTransferBench script '''
+#
+# This script will benchmark FileMD5CheckTransfer without partner servers:
+# - start local SFTP server (paramiko) on loopback
+# - generate synthetic OB archives and reports
+# - run nodetwo and nodeone directions end to end
+# - report files/sec, MB/s, peak RSS and scratch disk usage
+#
+# Results can be saved as JSON to compare versions:
+# ./FileMD5CheckTransferBench.py -w mixed --json before.json
+#
+
+import os
+import sys
+import time
+import json
+import errno
+import random
+import socket
+import shutil
+import logging
+import tarfile
+import argparse
+import resource
+import tempfile
+import threading
+import paramiko
+from paramiko import SFTPServer
+from paramiko import SFTPServerInterface
+from paramiko import SFTPHandle
+from paramiko import SFTPAttributes
+from paramiko import ServerInterface
+import FileMD5CheckTransfer
+
+# workloads: (number of OB archives, lines per archive),
+#            (number of reports, lines per report)
+WORKLOADS = {'small': ((200, 50), (200, 50)),
+             'huge': ((3, 500000), (3, 500000)),
+             'mixed': ((100, 50), (100, 50))}
+
+# mixed workload has also few huge files
+MIXED_HUGE = ((2, 250000), (2, 250000))
+
+# seconds between samples of RSS and scratch disk usage
+SAMPLE_INTERVAL = 0.2
+
+
+class BenchServer(ServerInterface):
+    ''' SSH server accepting every user and key '''
+    def check_auth_publickey(self, username, key):
+        ''' every key is fine '''
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        ''' only keys, like the real servers '''
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        ''' every channel is fine '''
+        return paramiko.OPEN_SUCCEEDED
+
+
+class BenchHandle(SFTPHandle):
+    ''' open file on the local SFTP server '''
+    def stat(self):
+        ''' attributes of open file '''
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def chattr(self, attr):
+        ''' attributes are not changed '''
+        return paramiko.SFTP_OK
+
+
+class BenchSFTP(SFTPServerInterface):
+    '''
+    BenchSFTP will serve files from local directory.
+    :param root: local directory used as / of the server
+    '''
+    def __init__(self, server, root):
+        ''' init method '''
+        SFTPServerInterface.__init__(self, server)
+        self.root = root
+
+    def __path(self, path):
+        ''' local path of remote path '''
+        return self.root + self.canonicalize(path)
+
+    def canonicalize(self, path):
+        ''' absolute remote path '''
+        return os.path.normpath('/' + path)
+
+    def list_folder(self, path):
+        ''' attributes of all files in directory '''
+        try:
+            local = self.__path(path)
+            files = []
+            for i in os.listdir(local):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(local, i)))
+                attr.filename = i
+                files.append(attr)
+            return files
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        ''' attributes of file '''
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.__path(path)))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        ''' open file for reading or writing '''
+        try:
+            fd = os.open(self.__path(path), flags, 0o644)
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = BenchHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        ''' delete file '''
+        try:
+            os.remove(self.__path(path))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        ''' rename file '''
+        try:
+            os.rename(self.__path(oldpath), self.__path(newpath))
+        except OSError as error:
+            return SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+
+class LocalSFTP(object):
+    '''
+    LocalSFTP will run SFTP server on loopback in background threads.
+    :param root: local directory used as / of the server
+    '''
+    def __init__(self, root):
+        ''' init method, listens on a free port '''
+        self.root = root
+        self.key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.__accept)
+        thread.daemon = True
+        thread.start()
+
+    def __accept(self):
+        ''' accept connections forever '''
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler('sftp', SFTPServer,
+                                            BenchSFTP, self.root)
+            try:
+                transport.start_server(server=BenchServer())
+            except Exception as error:
+                logging.info('Cannot start SSH session: %s', error)
+
+    def close(self):
+        ''' stop accepting connections '''
+        self.sock.close()
+
+
+class Sampler(object):
+    '''
+    Sampler will track peak RSS of this process and peak size
+    of scratch directories while a run is going on.
+    :param directories: local directories to measure
+    '''
+    def __init__(self, directories):
+        ''' init method '''
+        self.directories = directories
+        self.rss = 0
+        self.disk = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.__loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __loop(self):
+        ''' sample until stopped '''
+        while self.running:
+            self.sample()
+            time.sleep(SAMPLE_INTERVAL)
+
+    def sample(self):
+        ''' take one sample '''
+        self.rss = max(self.rss, self.current_rss())
+        self.disk = max(self.disk, sum(self.disk_usage(i)
+                                       for i in self.directories))
+
+    def stop(self):
+        ''' stop sampling, return (peak RSS, peak disk) in bytes '''
+        self.running = False
+        self.thread.join()
+        self.sample()
+        return self.rss, self.disk
+
+    @staticmethod
+    def current_rss():
+        '''
+        This function return RSS of this process in bytes, peak RSS
+        from getrusage when /proc is not there
+        '''
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except (IOError, IndexError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    @staticmethod
+    def disk_usage(directory):
+        '''
+        This function return bytes used by files in directory
+        '''
+        size = 0
+        for root, dirs, files in os.walk(directory):
+            for i in files:
+                try:
+                    size += os.lstat(os.path.join(root, i)).st_blocks * 512
+                except OSError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+        return size
+
+
+class Bench(object):
+    '''
+    Bench will generate workloads and run FileMD5CheckTransfer on them.
+    :param scratch: local directory for server files and temp dirs
+    :param options: Files arguments used for every run
+    :param scale: multiply number of lines in every file
+    '''
+    def __init__(self, scratch, options, scale=1.0):
+        ''' init method, starts the server and sets up the module '''
+        self.scratch = scratch
+        self.options = options
+        self.scale = scale
+        self.root = os.path.join(scratch, 'server')
+        self.work = os.path.join(scratch, 'work')
+        self.server = LocalSFTP(self.root)
+
+        keyfile = os.path.join(scratch, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(keyfile)
+        module = FileMD5CheckTransfer
+        module.TEMP_DIR = os.path.join(self.work, 'temp') + '/'
+        module.TEMP_DIR_UNCOMPRESS = os.path.join(self.work, 'uncompress') + '/'
+        module.BACKUP_PATH = os.path.join(self.work, 'backup') + '/'
+        for node in ('NODEONE', 'NODETWO'):
+            setattr(module, node + '_IP', '127.0.0.1')
+            setattr(module, node + '_PORT', self.server.port)
+            setattr(module, node + '_USERNAME', 'bench')
+            setattr(module, node + '_PUBLIC_KEY', keyfile)
+
+    def __reset(self):
+        ''' empty server and local directories '''
+        for i in (self.root, self.work):
+            shutil.rmtree(i, True)
+        for i in ('in', 'out', 'reports', 'reports_out'):
+            os.makedirs(os.path.join(self.root, i))
+        for i in ('temp', 'uncompress', 'backup'):
+            os.makedirs(os.path.join(self.work, i))
+
+    def __lines(self, filename, header, lines):
+        ''' write csv file with header and random lines '''
+        rand = random.Random(filename)
+        with open(filename, 'w') as f:
+            f.write(header + '\n')
+            for n in xrange(int(lines * self.scale)):
+                f.write('%d;%032x;user%d@example.com\n' % (
+                    n, rand.getrandbits(128), rand.randint(0, 99999)))
+
+    @staticmethod
+    def __files(workload, direction):
+        ''' files of workload and direction as list of (count, lines) '''
+        n = 0 if direction == 'nodetwo' else 1
+        if workload == 'mixed':
+            return [WORKLOADS[workload][n], MIXED_HUGE[n]]
+        return [WORKLOADS[workload][n]]
+
+    def generate(self, workload, direction):
+        '''
+        This function create OB archives with md5 files (nodetwo) or
+        reports (nodeone) on the server.
+        Return (files, bytes) waiting there.
+        '''
+        self.__reset()
+        if direction == 'nodeone':
+            n = 0
+            for count, lines in self.__files(workload, direction):
+                for i in xrange(count):
+                    name = 'RP_%s_%05d.csv' % (workload, n)
+                    n += 1
+                    self.__lines(os.path.join(self.root, 'reports', name),
+                                 'RP;id;mail', lines)
+            return self.__size(os.path.join(self.root, 'reports'))
+
+        source = os.path.join(self.work, 'source')
+        os.makedirs(source)
+        n = 0
+        for count, lines in self.__files(workload, direction):
+            for i in xrange(count):
+                name = 'OB_%s_%05d' % (workload, n)
+                n += 1
+                csv = os.path.join(source, name + '.csv')
+                self.__lines(csv, 'OB;id;mail', lines)
+                archive = os.path.join(self.root, 'in', name + '.tar.bz2')
+                tar = tarfile.open(archive, 'w:bz2')
+                tar.add(csv, name + '.csv')
+                tar.close()
+                os.remove(csv)
+                with open(archive[:-len('.tar.bz2')] + '.md5', 'w') as f:
+                    f.write('%s %s\n' % (FileMD5CheckTransfer.md5_file(archive),
+                                         name + '.tar.bz2'))
+        shutil.rmtree(source)
+        return self.__size(os.path.join(self.root, 'in'))
+
+    @staticmethod
+    def __size(directory):
+        ''' (number of files, bytes) in directory '''
+        files = os.listdir(directory)
+        return len(files), sum(os.path.getsize(os.path.join(directory, i))
+                               for i in files)
+
+    def run(self, workload, direction, inbound):
+        '''
+        This function run one direction and return its results.
+        inbound: (files, bytes) waiting on the server
+        '''
+        if direction == 'nodetwo':
+            args = ('OB', '/in', '/out/')
+            output = os.path.join(self.root, 'out')
+        else:
+            args = ('RP', '/reports_out/', '/reports')
+            output = os.path.join(self.root, 'reports_out')
+        sampler = Sampler([self.work])
+        start = time.time()
+        run = FileMD5CheckTransfer.Files(*args, **self.options)
+        run.main(direction)
+        seconds = time.time() - start
+        rss, disk = sampler.stop()
+        files, size = self.__size(output)
+        return {'workload': workload,
+                'direction': direction,
+                'seconds': round(seconds, 3),
+                'files_in': inbound[0],
+                'bytes_in': inbound[1],
+                'files_out': files,
+                'bytes_out': size,
+                'files_per_second': round(inbound[0] / seconds, 2),
+                'mb_per_second': round(inbound[1] / 1048576.0 / seconds, 2),
+                'peak_rss': rss,
+                'peak_children_rss': resource.getrusage(
+                    resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+                'peak_scratch': disk,
+                'stages': run.metrics.report()['stages']}
+
+    def close(self):
+        ''' stop the server '''
+        self.server.close()
+
+
+def main():
+    ''' parse arguments and run benchmarks '''
+    parser = argparse.ArgumentParser(
+        description='Benchmark FileMD5CheckTransfer on local SFTP server')
+    parser.add_argument('-w', '--workload', action='append',
+                        choices=sorted(WORKLOADS),
+                        help='Workload to run, all of them by default')
+    parser.add_argument('-d', '--direction', action='append',
+                        choices=['nodetwo', 'nodeone'],
+                        help='Direction to run, both by default')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Number of runs of every workload')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply number of lines in every file')
+    parser.add_argument('--scratch',
+                        help='Directory for server files and temp dirs')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Save results to JSON file')
+    parser.add_argument('--workers', type=int,
+                        default=FileMD5CheckTransfer.WORKERS,
+                        help='Concurrent SFTP transfers per host')
+    parser.add_argument('-p', '--processes', type=int,
+                        default=FileMD5CheckTransfer.PROCESSES,
+                        help='Processes verifying and uncompressing files')
+    parser.add_argument('--stream', action='store_true',
+                        help='Hash files while downloading them')
+    parser.add_argument('--stream-extract', action='store_true',
+                        help='Upload members while uncompressing archives')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show logs of FileMD5CheckTransfer')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(stream=sys.stderr,
+                        level=logging.INFO if args['verbose'] else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if not args['verbose']:
+        # both ends of every session are here, closing them is not an error
+        logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    scratch = args['scratch'] or tempfile.mkdtemp(prefix='filemd5bench')
+    bench = Bench(scratch,
+                  {'workers': args['workers'],
+                   'processes': args['processes'],
+                   'stream': args['stream'],
+                   'stream_extract': args['stream_extract']},
+                  args['scale'])
+    results = []
+    print '%-8s %-8s %8s %8s %10s %9s %10s %11s' % (
+        'workload', 'to', 'files', 'seconds', 'files/s', 'MB/s',
+        'RSS MB', 'scratch MB')
+    try:
+        for workload in args['workload'] or ['small', 'huge', 'mixed']:
+            for direction in args['direction'] or ['nodetwo', 'nodeone']:
+                for i in xrange(args['repeat']):
+                    inbound = bench.generate(workload, direction)
+                    result = bench.run(workload, direction, inbound)
+                    results.append(result)
+                    print '%-8s %-8s %8d %8.2f %10.2f %9.2f %10.1f %11.1f' % (
+                        workload, direction, result['files_in'],
+                        result['seconds'], result['files_per_second'],
+                        result['mb_per_second'],
+                        result['peak_rss'] / 1048576.0,
+                        result['peak_scratch'] / 1048576.0)
+                    sys.stdout.flush()
+    finally:
+        bench.close()
+        if not args['scratch']:
+            shutil.rmtree(scratch, True)
+
+    if args['json']:
+        with open(args['json'], 'w') as f:
+            source = os.path.splitext(FileMD5CheckTransfer.__file__)[0] + '.py'
+            json.dump({'version': FileMD5CheckTransfer.md5_file(source),
+                       'options': bench.options,
+                       'scale': args['scale'],
+                       'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,451 @@
 #
 
 import os
+import re
 import sys
+import time
+import json
+import hashlib
 import argparse
+import sqlite3
+import tempfile
+import multiprocessing
+from collections import OrderedDict
 import psycopg2
+from psycopg2.extras import execute_values
 
 TABLES = ['table1', 'table2', 'table3'] # specify your own tables
+COLUMNS = ['email'] # columns with mails in every table
+BATCH_SIZE = 1000 # rows selected and updated by one query
+COMMIT_INTERVAL = 10000 # rows updated between commits
+WORKERS = 1 # parallel workers, each of them with its own connection
+RANGE_SIZE = 1000000 # ids of one table given to one worker at once
+STRATEGY = 'batch' # batch: batched UPDATEs, copy: COPY and one UPDATE
+MATCH = 'my_domain' # only mails containing it are checked
+OLD_DOMAIN = 'old_domain' # replaced in mails
+NEW_DOMAIN = 'new_domain' # replacing it
+CHECKPOINT_TABLE = 'rebranding_checkpoint' # progress of every table
+CHANGES_FORMAT = 'tsv' # tsv: table id column old new, psql: script to apply
+CHANGES_BUFFER = 1024 * 1024 # bytes buffered before writing change file
+BACKEND = 'postgresql' # sqlite is a local stand-in for benchmarks
+
+# connection of the worker process, see init_worker()
+WORKER = {}
+
+
+def load_config(filename):
+    '''
+    function reading tables, columns and domain mappings from
+    JSON config file:
+    {"tables": {"table1": ["email"], "table2": ["email", "contact"]},
+     "mappings": {"old_domain": "new_domain", "brand.com": "new.com"},
+     "match": ["old_domain", "brand.com"]}
+    match is optional, mails containing any of mapped domains
+    are checked by default
+    return (tables, {table: columns}, mappings, match)
+    '''
+    def text(value):
+        ''' JSON strings are unicode, mails from database are not '''
+        return value.encode('utf-8')
+
+    try:
+        with open(filename) as f:
+            config = json.load(f, object_pairs_hook=OrderedDict)
+        columns = OrderedDict((text(table), [text(i) for i in names])
+                              for table, names in config['tables'].items())
+        mappings = dict((text(old), text(new))
+                        for old, new in config['mappings'].items())
+        match = [text(i) for i in config.get('match') or sorted(mappings)]
+        if not columns or not mappings:
+            raise ValueError('tables and mappings cannot be empty')
+    except Exception as error:
+        print "Cannot read config: %s, %s" % (filename, error)
+        sys.exit(1)
+    return list(columns), dict(columns), mappings, match
+
+
+def candidate(columns, match, params=False):
+    '''
+    function returning SQL condition for rows which may change,
+    unlike SIMILAR TO (a regex) LIKE can use trigram index
+    columns: columns with mails
+    match: mails containing any of them may change
+    params: True for queries with parameters, % is doubled then
+    '''
+    where = []
+    for column in columns:
+        for i in match:
+            pattern = "'%%%s%%'" % i.replace("'", "''")
+            if params:
+                pattern = pattern.replace('%', '%%')
+            where.append("%s LIKE %s" % (column, pattern))
+    return '(%s)' % ' OR '.join(where)
+
+
+def copy_text(value):
+    '''
+    function returning value in COPY text format, as it comes
+    from COPY TO STDOUT
+    '''
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+def copy_value(text):
+    '''
+    function returning value of field in COPY text format
+    '''
+    if text == '\\N':
+        return None
+    return re.sub(r'\\(.)', lambda i: {'t': '\t', 'n': '\n', 'r': '\r'}.get(
+        i.group(1), i.group(1)), text)
+
+
+def index_name(table, column):
+    '''
+    function returning name of trigram index created for column
+    '''
+    return 'rebranding_%s_%s_trgm' % (table.replace('.', '_'), column)
+
+
+class Rules(object):
+    '''
+    Rules will change all mapped domains in one pass over a mail,
+    mappings are compiled into one regex and one dict lookup.
+    :param mappings: {old domain: new domain}
+    :param columns: {table: columns}, part of the version only
+    '''
+    def __init__(self, mappings, columns):
+        self.mappings = mappings
+        # longest first, so sub.brand.com wins over brand.com
+        self.pattern = re.compile('|'.join(
+            re.escape(i) for i in sorted(mappings, key=len, reverse=True)))
+        # checkpoints made with other rules are not resumed
+        self.version = hashlib.md5(json.dumps(
+            [sorted(mappings.items()), sorted(columns.items())])).hexdigest()[:12]
+        # {old domain: replacements}, for the summary
+        self.counts = {}
+
+    def replace(self, match):
+        ''' method returning new domain for matched old one '''
+        old = match.group(0)
+        self.counts[old] = self.counts.get(old, 0) + 1
+        return self.mappings[old]
+
+    def change(self, mail):
+        '''
+        method returning mail with all mapped domains replaced
+        '''
+        return self.pattern.sub(self.replace, mail)
+
+
+class ChangeFile(object):
+    '''
+    File with all changes of a dry run, written through a big buffer.
+    tsv: one line per changed column (table, id, column, old, new)
+    psql: script for psql -f, changes of every table are copied into
+    a staging table and applied by one UPDATE, only to rows which
+    still have the old mails
+    :param filename: file to write
+    :param fmt: tsv or psql
+    :param columns: {table: columns}
+    '''
+    def __init__(self, filename, fmt, columns):
+        self.fmt = fmt
+        self.columns = columns
+        self.table = None
+        try:
+            self.output = open(filename, 'w', CHANGES_BUFFER)
+            if fmt == 'tsv':
+                self.output.write('table\tid\tcolumn\told\tnew\n')
+            else:
+                self.output.write('\\set ON_ERROR_STOP on\n')
+        except Exception as error:
+            print "Cannot write changes: %s, %s" % (filename, error)
+            sys.exit(1)
+
+    def write(self, table, old, new):
+        '''
+        method for writing one changed row
+        table: table name from TABLES
+        old, new: fields in COPY text format, id first
+        '''
+        if self.fmt == 'tsv':
+            for column, old_mail, new_mail in zip(self.columns[table],
+                                                  old[1:], new[1:]):
+                if old_mail != new_mail:
+                    self.output.write('\t'.join(
+                        (table, old[0], column, old_mail, new_mail)) + '\n')
+            return
+        if table != self.table:
+            self.table_end()
+            self.table_start(table)
+        self.output.write('\t'.join(list(new) + list(old[1:])) + '\n')
+
+    def table_start(self, table):
+        ''' method for starting COPY of table changes in psql script '''
+        columns = self.columns[table]
+        self.table = table
+        self.output.write(
+            "\nBEGIN;\n"
+            "CREATE TEMP TABLE rebranding_changes ON COMMIT DROP AS\n"
+            "  SELECT id, %s FROM %s WITH NO DATA;\n"
+            "COPY rebranding_changes (id, %s) FROM STDIN;\n" % (
+                ', '.join(['%s AS new_%s' % (i, i) for i in columns] +
+                          ['%s AS old_%s' % (i, i) for i in columns]),
+                table,
+                ', '.join(['new_%s' % i for i in columns] +
+                          ['old_%s' % i for i in columns])))
+
+    def table_end(self):
+        ''' method for applying COPY-ed table changes in psql script '''
+        if self.table is None:
+            return
+        table, columns = self.table, self.columns[self.table]
+        self.output.write(
+            "\\.\n"
+            "ANALYZE rebranding_changes;\n"
+            "UPDATE %s SET %s\n"
+            "  FROM rebranding_changes AS changes\n"
+            "  WHERE %s.id = changes.id%s;\n"
+            "COMMIT;\n" % (
+                table,
+                ', '.join('%s = changes.new_%s' % (i, i) for i in columns),
+                table,
+                ''.join('\n    AND %s.%s IS NOT DISTINCT FROM changes.old_%s'
+                        % (table, i, i) for i in columns)))
+        self.table = None
+
+    def close(self):
+        ''' method for finishing and flushing the file '''
+        if self.fmt == 'psql':
+            self.table_end()
+        self.output.close()
+
+
+def init_worker(case):
+    '''
+    function connecting once in every worker process
+    case: CaseCode object
+    '''
+    conn = case.connect()
+    WORKER['case'] = case
+    WORKER['conn'] = conn
+    WORKER['cur'] = conn.cursor()
+
+
+def rebrand_range(job):
+    '''
+    function changing mails of one id range in a worker process
+    job: (table, first id, last id)
+    return (table, rows updated by this run or None when it failed,
+            {old domain: replacements})
+    '''
+    table, low, high = job
+    case = WORKER['case']
+    try:
+        updated = case.rebrand_table(table, WORKER['conn'], WORKER['cur'],
+                                     low, high)
+    except SystemExit:
+        # error was printed already, keep the worker alive
+        WORKER['conn'].rollback()
+        updated = None
+    return table, updated, case.replaced.pop(table, {})
+
+
+class CopyChanges(object):
+    '''
+    File object receiving COPY output with (id, mail columns) rows,
+    changed rows are written as COPY input for the staging table,
+    unchanged rows are dropped.
+    :param case: CaseCode object
+    :param output: file for changed rows
+    :param table: table name, for dry-run output
+    '''
+    def __init__(self, case, output, table):
+        self.case = case
+        self.output = output
+        self.table = table
+        self.rest = ''
+        self.changed = 0
+
+    def write(self, data):
+        ''' method for receiving next piece of COPY output '''
+        lines = (self.rest + data).split('\n')
+        self.rest = lines.pop()
+        for line in lines:
+            fields = line.split('\t')
+            # \\N is NULL in COPY text format
+            new_fields = [fields[0]] + [
+                i if i == '\\N' else self.case.change_mail(i)
+                for i in fields[1:]]
+            if new_fields == fields:
+                continue
+            self.changed += 1
+            if self.case.debug:
+                self.case.show_change(self.table, fields, new_fields)
+            else:
+                self.output.write('\t'.join(new_fields) + '\n')
+
+
+class PostgresBackend(object):
+    '''
+    PostgresBackend runs the statements which differ between
+    databases, on PostgreSQL with psycopg2.
+    '''
+    @staticmethod
+    def connect(case):
+        ''' method for connecting to the database of case '''
+        return psycopg2.connect(dbname=case.database,
+                                user=case.user,
+                                host=case.hostname,
+                                password=case.password)
+
+    @staticmethod
+    def update(cur, table, columns, rows):
+        ''' method for updating all rows by one statement '''
+        execute_values(
+            cur,
+            """UPDATE %s SET %s
+               FROM (VALUES %%s) AS data (id, %s)
+               WHERE %s.id = data.id""" % (
+                   table, ', '.join('%s = data.%s' % (i, i) for i in columns),
+                   ', '.join(columns), table),
+            rows, page_size=len(rows))
+
+    @staticmethod
+    def estimate_rows(cur, table):
+        ''' method for getting estimated number of rows from statistics '''
+        cur.execute("SELECT reltuples::bigint FROM pg_class "
+                    "WHERE oid = %s::regclass", (table,))
+        return max(cur.fetchone()[0], 0)
+
+    @staticmethod
+    def staging_create(cur, table, columns):
+        ''' method for creating empty staging table like table '''
+        cur.execute(
+            """CREATE TEMP TABLE rebranding_staging ON COMMIT DROP
+               AS SELECT id, %s FROM %s WITH NO DATA""" % (
+                   ', '.join(columns), table))
+
+    @staticmethod
+    def copy_out(cur, query, output):
+        ''' method for writing rows of query to file in COPY text format '''
+        cur.copy_expert("COPY (%s) TO STDOUT" % query, output)
+
+    @staticmethod
+    def copy_in(cur, table, columns, source):
+        ''' method for reading rows in COPY text format into table '''
+        cur.copy_expert("COPY %s (%s) FROM STDIN" % (
+            table, ', '.join(columns)), source)
+
+
+class SqliteCursor(object):
+    '''
+    SqliteCursor takes queries with %s parameters like psycopg2.
+    :param cursor: sqlite3 cursor
+    '''
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=None):
+        ''' method for executing query, %s are changed to ? '''
+        if params is None:
+            return self.cursor.execute(query)
+        return self.cursor.execute(re.sub(
+            r'%([%s])', lambda i: '?' if i.group(1) == 's' else '%', query),
+            params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SqliteConnection(object):
+    '''
+    SqliteConnection gives SqliteCursor objects.
+    :param conn: sqlite3 connection
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        ''' method returning new cursor '''
+        return SqliteCursor(self.conn.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class SqliteBackend(object):
+    '''
+    SqliteBackend runs the statements which differ between
+    databases, on SQLite file given as database. It is a local
+    stand-in for benchmarks: COPY is emulated, preflight and
+    trigram indexes are not there.
+    '''
+    @staticmethod
+    def connect(case):
+        ''' method for connecting to the database of case '''
+        # parallel workers wait for the lock of the file
+        conn = sqlite3.connect(case.database, timeout=600)
+        # mails are byte strings, like with psycopg2
+        conn.text_factory = str
+        return SqliteConnection(conn)
+
+    @staticmethod
+    def update(cur, table, columns, rows):
+        ''' method for updating all rows by one statement '''
+        cur.execute(
+            """WITH data (id, %s) AS (VALUES %s)
+               UPDATE %s SET %s
+               FROM data WHERE %s.id = data.id""" % (
+                   ', '.join(columns),
+                   ', '.join(['(%s)' % ', '.join(['%s'] * (len(columns) + 1))]
+                             * len(rows)),
+                   table, ', '.join('%s = data.%s' % (i, i) for i in columns),
+                   table),
+            [i for row in rows for i in row])
+
+    @staticmethod
+    def estimate_rows(cur, table):
+        ''' method for getting number of rows, there are no statistics '''
+        cur.execute("SELECT count(*) FROM %s" % table)
+        return cur.fetchone()[0]
+
+    @staticmethod
+    def staging_create(cur, table, columns):
+        ''' method for creating empty staging table like table '''
+        cur.execute("DROP TABLE IF EXISTS temp.rebranding_staging")
+        cur.execute(
+            """CREATE TEMP TABLE rebranding_staging
+               AS SELECT id, %s FROM %s WHERE 0""" % (
+                   ', '.join(columns), table))
+
+    @staticmethod
+    def copy_out(cur, query, output):
+        ''' method for writing rows of query to file in COPY text format '''
+        cur.execute(query)
+        while True:
+            rows = cur.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            output.write(''.join('\t'.join(
+                [str(row[0])] + [copy_text(i) for i in row[1:]]) + '\n'
+                                 for row in rows))
+
+    @staticmethod
+    def copy_in(cur, table, columns, source):
+        ''' method for reading rows in COPY text format into table '''
+        cur.executemany(
+            "INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ', '.join(columns), ', '.join(['?'] * len(columns))),
+            ([copy_value(i) for i in line.rstrip('\n').split('\t')]
+             for line in source))
+
+
+BACKENDS = {'postgresql': PostgresBackend, 'sqlite': SqliteBackend}
 
 
 class CaseCode(object):
@@ -21,14 +461,58 @@ class CaseCode(object):
     :param user: username for postgresql
     :param password: password for postgresql
     :param database: database where we need to connect
+    :param batch_size: rows selected and updated by one query
+    :param commit_interval: rows updated between commits
+    :param workers: number of parallel workers
+    :param range_size: ids of one table given to one worker at once
+    :param strategy: batch or copy
+    :param checkpoint: save progress and resume from it, checkpoints
+                       are cleared when the whole run succeeds
+    :param preflight: only show query plans of tables
+    :param create_index: create trigram indexes on mail columns before the run
+    :param keep_index: do not drop the index after the run
+    :param config: JSON file with tables, columns and mappings
+    :param changes: file for changes of dry run, stdout by default
+    :param changes_format: tsv or psql
+    :param backend: postgresql, or sqlite with database file
     '''
-    def __init__(self, user, database, debug=False):
+    def __init__(self, user, database, debug=False, batch_size=BATCH_SIZE,
+                 commit_interval=COMMIT_INTERVAL, workers=WORKERS,
+                 range_size=RANGE_SIZE, strategy=STRATEGY, checkpoint=False,
+                 preflight=False, create_index=False, keep_index=False,
+                 config=None, changes=None, changes_format=CHANGES_FORMAT,
+                 backend=BACKEND):
         self.user = user
         self.database = database
-        self.password = os.environ['PGPASSWORD']
+        self.password = os.environ.get('PGPASSWORD')
         self.port = 5432
         self.hostname = 'localhost'
         self.debug = debug
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.workers = workers
+        self.range_size = range_size
+        self.strategy = strategy
+        # nothing is changed in dry-run mode, so nothing to save
+        self.checkpoint = checkpoint and not debug
+        self.preflight = preflight
+        self.create_index = create_index
+        self.keep_index = keep_index
+        if config:
+            self.tables, self.columns, mappings, self.match = \
+                load_config(config)
+        else:
+            self.tables = TABLES
+            self.columns = dict((table, COLUMNS) for table in TABLES)
+            mappings = {OLD_DOMAIN: NEW_DOMAIN}
+            self.match = [MATCH]
+        self.rules = Rules(mappings, self.columns)
+        self.changes = changes if debug else None
+        self.changes_format = changes_format
+        self.change_file = None
+        # {table: {old domain: replacements}}
+        self.replaced = {}
+        self.backend = BACKENDS[backend]
 
     def main(self):
         ''' Main method '''
@@ -37,80 +521,605 @@ class CaseCode(object):
             print "Running in DRY-RUN mode."
 
         # Connect to the database
+        conn = self.connect()
+        cur = conn.cursor()
+        if self.checkpoint:
+            self.checkpoint_create(conn, cur)
+
+        if self.changes:
+            self.change_file = ChangeFile(self.changes, self.changes_format,
+                                          self.columns)
+
+        start = time.time()
+        try:
+            if self.create_index:
+                self.index_create(conn, cur)
+
+            if self.preflight:
+                # Only show what the queries would do
+                for table in self.tables:
+                    self.explain(table, cur)
+                summary = None
+            elif self.workers > 1:
+                summary = self.main_parallel(conn, cur)
+            else:
+                # Iterate over tables that we want to check
+                summary = {}
+                for table in self.tables:
+                    print "\nWorking on table: %s" % table
+                    summary[table] = self.rebrand_table(table, conn, cur)
+        finally:
+            if self.create_index and not self.keep_index:
+                self.index_drop(conn, cur)
+            if self.change_file:
+                self.change_file.close()
+
+        # Next runs start again, new rows may match by then
+        if self.checkpoint and summary and None not in summary.values():
+            self.checkpoint_clear(conn, cur)
+
+        # Close database connection
+        cur.close()
+        conn.close()
+
+        if summary is None:
+            return
+
+        self.print_summary(summary, time.time() - start)
+        if None in summary.values():
+            sys.exit(1)
+        return summary
+
+    def main_parallel(self, conn, cur):
+        '''
+        method for changing mails with many workers, tables are
+        split into id ranges and every range goes to one worker
+        conn: connection object
+        cur: cursor object
+        return {table: rows updated by this run or None when it failed}
+        '''
+        jobs = []
+        for table in self.tables:
+            jobs.extend((table, low, high)
+                        for low, high in self.id_ranges(table, cur))
+        # do not keep a snapshot open while workers run
+        conn.commit()
+        print "Working on %d tables in %d ranges with %d workers" % (
+            len(self.tables), len(jobs), self.workers)
+
+        summary = dict((table, 0) for table in self.tables)
+        pool = multiprocessing.Pool(self.workers, init_worker, (self,))
+        try:
+            for table, updated, replaced in pool.imap_unordered(
+                    rebrand_range, jobs):
+                self.add_replaced(table, replaced)
+                if updated is None or summary[table] is None:
+                    summary[table] = None
+                else:
+                    summary[table] += updated
+        finally:
+            pool.close()
+            pool.join()
+        return summary
+
+    def connect(self):
+        ''' method for connecting to the database '''
         try:
-            conn = psycopg2.connect(dbname=self.database,
-                                    user=self.user,
-                                    host=self.hostname,
-                                    password=self.password)
-            cur = conn.cursor()
+            return self.backend.connect(self)
         except Exception as error:
             print "Cannot connect to database: %s" % error
             sys.exit(1)
 
-        # Iterate over tables that we want to check
-        for table in TABLES:
-            print "\nWorking on table: %s" % table
+    def id_ranges(self, table, cur):
+        '''
+        method for splitting table into ranges of range_size ids
+        table: table name from TABLES
+        cur: cursor object
+        return list of (first id, last id)
+        '''
+        low, high = self.id_bounds(table, cur)
+        if low is None:
+            return []
+        return [(i, min(i + self.range_size - 1, high))
+                for i in xrange(low, high + 1, self.range_size)]
 
-            # Main query for each table
-            rows = self.query_select(table, cur)
+    @staticmethod
+    def id_bounds(table, cur):
+        '''
+        method for getting first and last id of the table
+        table: table name from TABLES
+        cur: cursor object
+        return (min id, max id), (None, None) for empty table
+        '''
+        try:
+            cur.execute("SELECT min(id), max(id) FROM %s" % (table))
+            return cur.fetchone()
+        except Exception as error:
+            print "Cannot execute query: %s" % error
+            sys.exit(1)
 
-            # Check if there are records to parse
-            if not rows:
-                print " -> no records to replace"
+    def estimate_rows(self, table, cur):
+        '''
+        method for getting estimated number of rows from statistics
+        table: table name from TABLES
+        cur: cursor object
+        '''
+        try:
+            return self.backend.estimate_rows(cur, table)
+        except Exception as error:
+            print "Cannot execute query: %s" % error
+            sys.exit(1)
+
+    @staticmethod
+    def checkpoint_create(conn, cur):
+        '''
+        method for creating checkpoint table when it is missing
+        conn: connection object
+        cur: cursor object
+        '''
+        try:
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS %s (
+                   table_name text NOT NULL,
+                   id_range text NOT NULL,
+                   last_id bigint,
+                   rows_updated bigint NOT NULL DEFAULT 0,
+                   mapping_version text NOT NULL,
+                   done boolean NOT NULL DEFAULT false,
+                   updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                   PRIMARY KEY (table_name, id_range))""" % (CHECKPOINT_TABLE))
+            conn.commit()
+        except Exception as error:
+            print "Cannot create checkpoint table: %s" % error
+            sys.exit(1)
+
+    def checkpoint_clear(self, conn, cur):
+        '''
+        method for removing checkpoints of all tables after
+        the whole run succeeded
+        conn: connection object
+        cur: cursor object
+        '''
+        try:
+            cur.execute("DELETE FROM %s WHERE table_name IN (%s)" % (
+                CHECKPOINT_TABLE, ', '.join(['%s'] * len(self.tables))),
+                        self.tables)
+            conn.commit()
+        except Exception as error:
+            print "Cannot clear checkpoints: %s" % error
+            sys.exit(1)
+
+    def checkpoint_load(self, table, id_range, cur):
+        '''
+        method for reading checkpoint of table (or its range)
+        table: table name from TABLES
+        id_range: 'all' or 'low-high'
+        cur: cursor object
+        return (last id, rows updated, done), (None, 0, False) when
+        there is no checkpoint or it was made with other mapping
+        '''
+        if not self.checkpoint:
+            return None, 0, False
+        try:
+            cur.execute(
+                """SELECT last_id, rows_updated, done, mapping_version
+                   FROM %s WHERE table_name = %%s AND id_range = %%s""" % (
+                       CHECKPOINT_TABLE), (table, id_range))
+            row = cur.fetchone()
+        except Exception as error:
+            print "Cannot read checkpoint: %s" % error
+            sys.exit(1)
+        if not row:
+            return None, 0, False
+        if row[3] != self.rules.version:
+            print " %s -> checkpoint of other mapping, starting again" % table
+            return None, 0, False
+        return row[0], row[1], row[2]
+
+    def checkpoint_save(self, table, id_range, last_id, updated, done, cur):
+        '''
+        method for saving checkpoint, it is committed together
+        with the rows it describes
+        table: table name from TABLES
+        id_range: 'all' or 'low-high'
+        last_id: last processed id
+        updated: rows updated in table (or its range) so far
+        done: True when whole table (or its range) is done
+        cur: cursor object
+        '''
+        if not self.checkpoint:
+            return
+        try:
+            cur.execute(
+                """INSERT INTO %s (table_name, id_range, last_id,
+                                    rows_updated, mapping_version, done,
+                                    updated_at)
+                   VALUES (%%s, %%s, %%s, %%s, %%s, %%s, CURRENT_TIMESTAMP)
+                   ON CONFLICT (table_name, id_range) DO UPDATE
+                   SET last_id = EXCLUDED.last_id,
+                       rows_updated = EXCLUDED.rows_updated,
+                       mapping_version = EXCLUDED.mapping_version,
+                       done = EXCLUDED.done,
+                       updated_at = EXCLUDED.updated_at""" % (
+                           CHECKPOINT_TABLE),
+                (table, id_range, last_id, updated, self.rules.version, done))
+        except Exception as error:
+            print "Cannot save checkpoint: %s" % error
+            sys.exit(1)
+
+    @staticmethod
+    def print_progress(name, first, last, resumed_id, last_id,
+                       estimate, updated, start):
+        '''
+        method for printing progress and ETA of table (or its range),
+        both are estimated from ids scanned so far
+        name: name of table (or its range) to show
+        first, last: ids of the table (or its range)
+        resumed_id: last id of the checkpoint this run started from
+        last_id: last processed id
+        estimate: estimated number of rows of the table (or its range)
+        updated: rows updated so far
+        start: time when this run started
+        '''
+        span = max(last - first + 1, 1)
+        line = " %s: %.1f%% of ~%d rows, %d records replaced" % (
+            name, min(100.0, 100.0 * (last_id - first + 1) / span),
+            estimate, updated)
+        speed = (last_id - resumed_id) / max(time.time() - start, 0.001)
+        if speed > 0:
+            line += ", ETA %ds" % (max(last - last_id, 0) / speed)
+        print line
+        sys.stdout.flush()
+
+    def explain(self, table, cur):
+        '''
+        method for printing query plan of selecting rows to change,
+        estimated rows, cost and how the table is scanned
+        table: table name from TABLES
+        cur: cursor object
+        '''
+        try:
+            cur.execute("EXPLAIN (FORMAT JSON) SELECT id, %s FROM %s "
+                        "WHERE %s" % (', '.join(self.columns[table]), table,
+                                      candidate(self.columns[table],
+                                                self.match)))
+            plan = cur.fetchone()[0]
+        except Exception as error:
+            print "Cannot explain query: %s" % error
+            sys.exit(1)
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        plan = plan[0]['Plan']
+
+        # Scans are the deepest nodes of the plan
+        scans = []
+        nodes = [plan]
+        while nodes:
+            node = nodes.pop()
+            if 'Scan' in node['Node Type']:
+                scans.append(node['Node Type'] + (
+                    ' using %s' % node['Index Name'] if 'Index Name' in node
+                    else ''))
+            nodes.extend(node.get('Plans', []))
+        print "%s: ~%d rows, cost %.0f, %s" % (
+            table, plan['Plan Rows'], plan['Total Cost'], ', '.join(scans))
+        if any(i.startswith('Seq Scan') for i in scans):
+            print " -> whole table is scanned, see --create-index"
+
+    def index_create(self, conn, cur):
+        '''
+        method for creating trigram indexes on mail columns,
+        CONCURRENTLY does not block writes but runs outside
+        of transaction
+        conn: connection object
+        cur: cursor object
+        '''
+        conn.rollback()
+        conn.autocommit = True
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for table in self.tables:
+                for column in self.columns[table]:
+                    start = time.time()
+                    cur.execute(
+                        """CREATE INDEX CONCURRENTLY IF NOT EXISTS %s
+                           ON %s USING gin (%s gin_trgm_ops)""" % (
+                               index_name(table, column), table, column))
+                    print "Created index %s in %.1fs" % (
+                        index_name(table, column), time.time() - start)
+        except Exception as error:
+            print "Cannot create index: %s" % error
+            sys.exit(1)
+        finally:
+            conn.autocommit = False
+
+    def index_drop(self, conn, cur):
+        '''
+        method for dropping trigram indexes made by index_create()
+        conn: connection object
+        cur: cursor object
+        '''
+        conn.rollback()
+        conn.autocommit = True
+        try:
+            for table in self.tables:
+                for column in self.columns[table]:
+                    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % (
+                        index_name(table, column)))
+                    print "Dropped index %s" % index_name(table, column)
+        except Exception as error:
+            print "Cannot drop index: %s" % error
+        finally:
+            conn.autocommit = False
+
+    def print_summary(self, summary, elapsed):
+        '''
+        method for printing rows changed in every table
+        summary: {table: rows updated by this run or None when it failed}
+        elapsed: seconds of the whole run
+        '''
+        print "\nSummary:"
+        for table in self.tables:
+            if summary.get(table) is None:
+                print " %s: FAILED" % table
             else:
-                for row in rows:
-                    self.query_update(row, table, cur)
+                print " %s: %d records replaced" % (table, summary[table])
+            replaced = self.replaced.get(table, {})
+            for old in sorted(replaced, key=replaced.get, reverse=True):
+                print "   %s -> %s: %d" % (old, self.rules.mappings[old],
+                                           replaced[old])
+        total = sum(i for i in summary.values() if i)
+        print " total: %d records replaced in %.1fs (%.0f rows/sec)" % (
+            total, elapsed, total / max(elapsed, 0.001))
+
+    def add_replaced(self, table, replaced):
+        '''
+        method for adding replacements of one table (or its range)
+        to the summary
+        table: table name from TABLES
+        replaced: {old domain: replacements}
+        '''
+        counts = self.replaced.setdefault(table, {})
+        for old, count in replaced.items():
+            counts[old] = counts.get(old, 0) + count
+
+    def show_change(self, table, old, new):
+        '''
+        method for showing one changed row in dry-run mode, it goes
+        to the change file or stdout as UPDATE statement
+        table: table name from TABLES
+        old, new: fields in COPY text format, id first
+        '''
+        if self.change_file:
+            self.change_file.write(table, old, new)
+            return
+        print "UPDATE %s SET %s WHERE id='%s';" % (table, ', '.join(
+            "%s=NULL" % column if mail == '\\N' else "%s='%s'" % (column, mail)
+            for column, old_mail, mail in zip(self.columns[table], old[1:],
+                                              new[1:])
+            if old_mail != mail), old[0])
 
-                # Comit database query
+    def rebrand_table(self, table, conn, cur, low=None, high=None):
+        '''
+        method for changing mails of one table with the strategy,
+        replacements of every mapping are counted for the summary
+        table: table name from TABLES
+        conn: connection object
+        cur: cursor object
+        low, high: only ids from low to high when given
+        '''
+        self.rules.counts = {}
+        try:
+            if self.strategy == 'copy':
+                return self.rebrand_table_copy(table, conn, cur, low, high)
+            return self.rebrand_table_batch(table, conn, cur, low, high)
+        finally:
+            self.add_replaced(table, self.rules.counts)
+
+    def rebrand_table_batch(self, table, conn, cur, low=None, high=None):
+        '''
+        method for changing mails of one table batch by batch,
+        rows are read in id order (keyset pagination), so memory
+        does not grow with the table and commits do not break it
+        table: table name from TABLES
+        conn: connection object
+        cur: cursor object
+        low, high: only ids from low to high when given
+        '''
+        start = time.time()
+        id_range = 'all' if low is None else '%s-%s' % (low, high)
+        name = table if low is None else "%s [%s]" % (table, id_range)
+        last_id, updated, done = self.checkpoint_load(table, id_range, cur)
+        if done:
+            print " %s -> done already, %d records replaced" % (name, updated)
+            return 0
+        resumed = updated
+        if last_id is not None:
+            print " %s -> resuming after id %s" % (name, last_id)
+        elif low is not None:
+            last_id = low - 1
+
+        # Table size for progress
+        first, last = self.id_bounds(table, cur)
+        estimate = self.estimate_rows(table, cur)
+        if low is not None and first is not None:
+            estimate = estimate * (high - low + 1) / max(last - first + 1, 1)
+            first, last = low, high
+        resumed_id = last_id if last_id is not None else (first or 0) - 1
+
+        uncommitted = 0
+        while True:
+            # Next batch of matching rows
+            rows = self.query_select(table, cur, last_id, self.batch_size,
+                                     high)
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            # Only rows with a changed mail are written
+            changes = []
+            for row in rows:
+                new_row = (row[0],) + tuple(
+                    self.change_mail(i) for i in row[1:])
+                if new_row != tuple(row):
+                    changes.append(new_row)
+                    if self.debug:
+                        self.show_change(table,
+                                         [str(i) for i in row[:1]] +
+                                         [copy_text(i) for i in row[1:]],
+                                         [str(new_row[0])] +
+                                         [copy_text(i) for i in new_row[1:]])
+            # Run it only when debug is False
+            if changes and self.debug is False:
+                self.query_update(changes, table, cur)
+            updated += len(changes)
+            uncommitted += len(rows)
+
+            # Comit database query every commit_interval rows
+            if uncommitted >= self.commit_interval:
+                self.checkpoint_save(table, id_range, last_id, updated,
+                                     False, cur)
                 conn.commit()
+                uncommitted = 0
+                self.print_progress(name, first, last, resumed_id, last_id,
+                                    estimate, updated, start)
+        self.checkpoint_save(table, id_range, last_id, updated, True, cur)
+        conn.commit()
 
-        # Close database connection
-        cur.close()
-        conn.close()
+        self.print_table(table, low, high, updated - resumed, start)
+        # rows of previous runs are not work of this one
+        return updated - resumed
+
+    def rebrand_table_copy(self, table, conn, cur, low=None, high=None):
+        '''
+        method for changing mails of one table at COPY speed:
+        matching rows are copied out and changed as they stream
+        into a temporary file, copied into a staging table and
+        applied by one UPDATE, all in one transaction
+        table: table name from TABLES
+        conn: connection object
+        cur: cursor object
+        low, high: only ids from low to high when given
+        '''
+        start = time.time()
+        id_range = 'all' if low is None else '%s-%s' % (low, high)
+        last_id, updated, done = self.checkpoint_load(table, id_range, cur)
+        if done:
+            name = table if low is None else "%s [%s]" % (table, id_range)
+            print " %s -> done already, %d records replaced" % (name, updated)
+            return 0
+
+        columns = ', '.join(self.columns[table])
+        where = candidate(self.columns[table], self.match)
+        if low is not None:
+            where += " AND id BETWEEN %d AND %d" % (low, high)
+        try:
+            with tempfile.TemporaryFile() as staging:
+                changes = CopyChanges(self, staging, table)
+                self.backend.copy_out(
+                    cur, "SELECT id, %s FROM %s WHERE %s" % (
+                        columns, table, where), changes)
+                updated = changes.changed
+
+                # Run it only when debug is False
+                if self.debug is False and updated:
+                    staging.seek(0)
+                    self.backend.staging_create(cur, table,
+                                                self.columns[table])
+                    self.backend.copy_in(cur, 'rebranding_staging',
+                                         ['id'] + self.columns[table],
+                                         staging)
+                    cur.execute("ANALYZE rebranding_staging")
+                    cur.execute(
+                        """UPDATE %s SET %s
+                           FROM rebranding_staging AS staging
+                           WHERE %s.id = staging.id""" % (
+                               table, ', '.join(
+                                   '%s = staging.%s' % (i, i)
+                                   for i in self.columns[table]), table))
+                    updated = cur.rowcount
+            self.checkpoint_save(table, id_range, high, updated, True, cur)
+            conn.commit()
+        except Exception as error:
+            print "Cannot copy table: %s, %s" % (table, error)
+            conn.rollback()
+            sys.exit(1)
+
+        self.print_table(table, low, high, updated, start)
+        return updated
 
     @staticmethod
-    def query_select(table, cur):
+    def print_table(table, low, high, updated, start):
+        '''
+        method for printing rows changed in table (or its range)
+        '''
+        name = table
+        if low is not None:
+            name = "%s [%s-%s]" % (table, low, high)
+        if not updated:
+            print " %s -> no records to replace" % name
+        else:
+            elapsed = max(time.time() - start, 0.001)
+            print " %s -> %d records replaced in %.1fs (%.0f rows/sec)" % (
+                name, updated, elapsed, updated / elapsed)
+        # workers share stdout, do not mix their lines
+        sys.stdout.flush()
+
+    def query_select(self, table, cur, after=None, limit=BATCH_SIZE,
+                     upto=None):
+        '''
+        method for selecting next batch of rows to change
+        table: table name from TABLES
+        cur: cursor object
+        after: last id of previous batch or None
+        limit: number of rows
+        upto: last id of the range or None
+        '''
+        where = [candidate(self.columns[table], self.match, True)]
+        params = []
+        if after is not None:
+            where.append("id > %s")
+            params.append(after)
+        if upto is not None:
+            where.append("id <= %s")
+            params.append(upto)
+        params.append(limit)
         try:
             cur.execute(
-                """SELECT id, email FROM %s
-                WHERE email SIMILAR TO '%%my_domain%%'""" % (table))
+                """SELECT id, %s FROM %s
+                WHERE %s
+                ORDER BY id LIMIT %%s""" % (', '.join(self.columns[table]),
+                                           table, ' AND '.join(where)),
+                params)
             rows = cur.fetchall()
         except Exception as error:
             print "Cannot execute query: %s" % error
             sys.exit(1)
         return rows
 
-    def query_update(self, row, tablename, cur):
+    def query_update(self, rows, tablename, cur):
         '''
-        method for executing queries
-        row: row from the database
+        method for executing queries, all rows are updated
+        by one statement
+        rows: list of (id, new mails in columns order)
         tablename: table name from TABLES
-        cur: conn object
+        cur: cursor object
         '''
         try:
-            table_id = row[0]
-            table_email = row[1]
-            table_new_email = self.change_mail(table_email)
-
-            print "UPDATE %s SET email='%s' WHERE id='%s';" % (tablename, table_new_email, table_id)
-
-            # Run it only when debug is False
-            if self.debug is False:
-                cur.execute(
-                    """UPDATE %s SET email=('%s')
-                       WHERE id=('%s')""" % (tablename, table_new_email, table_id))
+            self.backend.update(cur, tablename, self.columns[tablename], rows)
         except Exception as error:
-            print "Cannot execute query: %s on %s, %s" % (row, tablename, error)
+            print "Cannot execute query: %s on %s, %s" % (rows[0], tablename, error)
             sys.exit(1)
 
-    @staticmethod
-    def change_mail(mail):
+    def change_mail(self, mail):
         '''
-        method for replacing old e-mail with new the new one
-        mail: old mail string
+        method for replacing old domains in e-mail with new ones
+        mail: old mail string or None
         '''
+        if mail is None:
+            return None
         try:
-            return mail.replace('old_domain', 'new_domain')
+            return self.rules.change(mail)
         except Exception as error:
             print "Cannot change mail: %s, %s" % (mail, error)
             sys.exit(1)
@@ -127,9 +1136,69 @@ if __name__ == '__main__':
                         help='PostgreSQL database', required=True)
     parser.add_argument('-t', '--dryrun', action='store_true',
                         help='Dry run mode', required=False)
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE,
+                        help='Rows selected and updated by one query',
+                        required=False)
+    parser.add_argument('-c', '--commit-interval', type=int,
+                        default=COMMIT_INTERVAL,
+                        help='Rows updated between commits', required=False)
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+                        help='Parallel workers, each with own connection',
+                        required=False)
+    parser.add_argument('-r', '--range-size', type=int, default=RANGE_SIZE,
+                        help='Ids of one table given to a worker at once',
+                        required=False)
+    parser.add_argument('-s', '--strategy', default=STRATEGY,
+                        choices=['batch', 'copy'],
+                        help='batch: batched UPDATEs, copy: COPY through '
+                             'staging table and one UPDATE per table',
+                        required=False)
+    parser.add_argument('-k', '--checkpoint', action='store_true',
+                        help='Save progress in %s table and resume from it, '
+                             'it is cleared when all tables succeed'
+                             % CHECKPOINT_TABLE, required=False)
+    parser.add_argument('-p', '--preflight', action='store_true',
+                        help='Only show query plans, rows and costs',
+                        required=False)
+    parser.add_argument('-i', '--create-index', action='store_true',
+                        help='Create trigram indexes on mail columns concurrently '
+                             'before the run and drop it afterwards',
+                        required=False)
+    parser.add_argument('--keep-index', action='store_true',
+                        help='Do not drop index made by --create-index',
+                        required=False)
+    parser.add_argument('-f', '--config',
+                        help='JSON file with tables, columns and domain '
+                             'mappings', required=False)
+    parser.add_argument('-o', '--changes',
+                        help='Write changes of dry run to file instead of '
+                             'stdout', required=False)
+    parser.add_argument('--changes-format', default=CHANGES_FORMAT,
+                        choices=['tsv', 'psql'],
+                        help='tsv: table, id, column, old and new mail, '
+                             'psql: COPY-ready script for psql -f applying '
+                             'reviewed changes', required=False)
+    parser.add_argument('--backend', default=BACKEND,
+                        choices=sorted(BACKENDS),
+                        help='sqlite: local stand-in, database is a file',
+                        required=False)
 
     args = vars(parser.parse_args())
+    if args['changes'] and not args['dryrun']:
+        parser.error('--changes works only with --dryrun')
+    if args['changes'] and args['workers'] > 1:
+        parser.error('--changes works only with one worker')
+    if args['backend'] == 'sqlite' and (args['preflight'] or
+                                        args['create_index']):
+        parser.error('--preflight and --create-index need postgresql')
 
     if args['user'] and args['database']:
-        start = CaseCode(args['user'], args['database'], args['dryrun'])
+        start = CaseCode(args['user'], args['database'], args['dryrun'],
+                         args['batch_size'], args['commit_interval'],
+                         args['workers'], args['range_size'],
+                         args['strategy'], args['checkpoint'],
+                         args['preflight'], args['create_index'],
+                         args['keep_index'], args['config'],
+                         args['changes'], args['changes_format'],
+                         args['backend'])
         start.main()
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+''' RebrandingBench script '''
+#
+# This script will benchmark Rebranding strategies on a local database:
+# - seed synthetic tables of given size and share of matching mails
+# - run every strategy (per-row, batched, copy, parallel) end to end,
+#   per-row is the loop Rebranding had before batches: one SELECT of
+#   all matching rows, then one UPDATE per row
+# - report rows/sec, changed rows/sec and peak RSS of all processes
+#
+# SQLite file is used by default, a throwaway local PostgreSQL can be
+# given instead (remember to export PGPASSWORD):
+# ./RebrandingBench.py --rows 200000 --ratio 0.3 --json before.json
+# ./RebrandingBench.py --backend postgresql -u bench -d bench_db
+#
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+import Rebranding
+
+# strategies: CaseCode options of every strategy, parallel one
+# gets workers and range_size from the command line, per-row
+# (None) is run by Bench.per_row()
+STRATEGIES = OrderedDict([
+    ('per-row', None),
+    ('batched', {'strategy': 'batch'}),
+    ('copy', {'strategy': 'copy'}),
+    ('parallel', {'strategy': 'batch'})])
+
+ROWS = 100000 # rows in every table
+RATIO = 0.3 # share of rows with mails to change
+TABLES = 1 # number of tables
+WORKERS = 4 # workers of parallel strategy
+OLD_DOMAIN = 'old-brand.example' # replaced in seeded mails
+NEW_DOMAIN = 'new-brand.example' # replacing it
+OTHER_DOMAIN = 'example.com' # in mails which do not change
+
+# seconds between samples of RSS
+SAMPLE_INTERVAL = 0.2
+
+
+class Sampler(object):
+    '''
+    Sampler will track peak RSS of this process together with its
+    worker processes while a run is going on.
+    '''
+    def __init__(self):
+        ''' init method '''
+        self.rss = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.__loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __loop(self):
+        ''' sample until stopped '''
+        while self.running:
+            self.sample()
+            time.sleep(SAMPLE_INTERVAL)
+
+    def sample(self):
+        ''' take one sample '''
+        pids = ['self'] + [i.pid for i in multiprocessing.active_children()]
+        self.rss = max(self.rss, sum(self.current_rss(i) for i in pids))
+
+    def stop(self):
+        ''' stop sampling, return peak RSS in bytes '''
+        self.running = False
+        self.thread.join()
+        self.sample()
+        return self.rss
+
+    @staticmethod
+    def current_rss(pid):
+        '''
+        This function return RSS of process in bytes, peak RSS of this
+        process from getrusage when /proc is not there
+        '''
+        try:
+            with open('/proc/%s/statm' % pid) as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except (IOError, IndexError, ValueError):
+            if pid != 'self':
+                return 0
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Bench(object):
+    '''
+    Bench will seed tables and run Rebranding strategies on them.
+    :param backend: postgresql or sqlite
+    :param user: PostgreSQL user
+    :param database: database name or SQLite file
+    :param scratch: local directory for config and SQLite file
+    :param rows: rows in every table
+    :param ratio: share of rows with mails to change
+    :param tables: number of tables
+    :param verbose: show output of Rebranding
+    '''
+    def __init__(self, backend, user, database, scratch, rows=ROWS,
+                 ratio=RATIO, tables=TABLES, verbose=False):
+        ''' init method, writes config of seeded tables '''
+        self.backend = backend
+        self.user = user
+        self.database = database
+        self.rows = rows
+        self.ratio = ratio
+        self.tables = ['rebranding_bench_%d' % i for i in xrange(tables)]
+        self.verbose = verbose
+        self.config = os.path.join(scratch, 'config.json')
+        with open(self.config, 'w') as f:
+            json.dump({'tables': dict((i, ['email']) for i in self.tables),
+                       'mappings': {OLD_DOMAIN: NEW_DOMAIN}}, f)
+
+    def case(self, **options):
+        ''' Rebranding.CaseCode for seeded tables '''
+        return Rebranding.CaseCode(self.user, self.database,
+                                   config=self.config, backend=self.backend,
+                                   **options)
+
+    def seed(self):
+        '''
+        This function create tables again and fill them with
+        synthetic mails.
+        Return number of rows to change.
+        '''
+        case = self.case()
+        conn = case.connect()
+        cur = conn.cursor()
+        matching = 0
+        for table in self.tables:
+            rand = random.Random(table)
+            cur.execute("DROP TABLE IF EXISTS %s" % table)
+            cur.execute("CREATE TABLE %s (id bigint PRIMARY KEY, email text)"
+                        % table)
+            with tempfile.TemporaryFile() as rows:
+                for n in xrange(1, self.rows + 1):
+                    if rand.random() < self.ratio:
+                        domain = OLD_DOMAIN
+                        matching += 1
+                    else:
+                        domain = OTHER_DOMAIN
+                    rows.write('%d\tuser%d@%s\n' % (n, n, domain))
+                rows.seek(0)
+                case.backend.copy_in(cur, table, ['id', 'email'], rows)
+            conn.commit()
+            cur.execute("ANALYZE %s" % table)
+            conn.commit()
+        cur.close()
+        conn.close()
+        return matching
+
+    def left(self):
+        ''' number of mails which were not changed '''
+        conn = self.case().connect()
+        cur = conn.cursor()
+        count = 0
+        for table in self.tables:
+            cur.execute("SELECT count(*) FROM %s WHERE email LIKE '%%%s%%'" % (
+                table, OLD_DOMAIN))
+            count += cur.fetchone()[0]
+        cur.close()
+        conn.close()
+        return count
+
+    @staticmethod
+    def per_row(case):
+        '''
+        This function change mails like Rebranding did before batches:
+        one SELECT of all matching rows of a table, one UPDATE for
+        every row and one commit per table.
+        Return {table: rows updated}.
+        '''
+        conn = case.connect()
+        cur = conn.cursor()
+        summary = {}
+        for table in case.tables:
+            print "\nWorking on table: %s" % table
+            cur.execute("SELECT id, %s FROM %s WHERE %s" % (
+                ', '.join(case.columns[table]), table,
+                Rebranding.candidate(case.columns[table], case.match)))
+            rows = cur.fetchall()
+            for row in rows:
+                mails = [case.change_mail(i) for i in row[1:]]
+                print "UPDATE %s SET %s WHERE id='%s';" % (table, ', '.join(
+                    "%s='%s'" % i for i in zip(case.columns[table], mails)),
+                                                       row[0])
+                cur.execute("UPDATE %s SET %s WHERE id = %%s" % (
+                    table, ', '.join('%s = %%s' % i
+                                     for i in case.columns[table])),
+                            mails + [row[0]])
+            conn.commit()
+            summary[table] = len(rows)
+        cur.close()
+        conn.close()
+        return summary
+
+    def run(self, name, options, matching):
+        '''
+        This function run one strategy on seeded tables and return
+        its results.
+        options: CaseCode options of the strategy, None for per-row
+        matching: number of rows to change
+        '''
+        case = self.case(**(options or {}))
+        stdout = sys.stdout
+        if not self.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        sampler = Sampler()
+        start = time.time()
+        try:
+            if options is None:
+                summary = self.per_row(case)
+            else:
+                summary = case.main()
+        finally:
+            seconds = time.time() - start
+            rss = sampler.stop()
+            if not self.verbose:
+                sys.stdout.close()
+                sys.stdout = stdout
+        rows = self.rows * len(self.tables)
+        changed = sum(summary.values())
+        return {'strategy': name,
+                'backend': self.backend,
+                'seconds': round(seconds, 3),
+                'rows': rows,
+                'matching': matching,
+                'changed': changed,
+                'left': self.left(),
+                'rows_per_second': round(rows / seconds, 1),
+                'changed_per_second': round(changed / seconds, 1),
+                'peak_rss': rss,
+                'peak_children_rss': resource.getrusage(
+                    resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+                'options': options}
+
+
+def main():
+    ''' parse arguments and run benchmarks '''
+    parser = argparse.ArgumentParser(
+        description='Benchmark Rebranding strategies on local database')
+    parser.add_argument('-s', '--strategy', action='append',
+                        choices=list(STRATEGIES),
+                        help='Strategy to run, all of them by default')
+    parser.add_argument('--backend', default='sqlite',
+                        choices=sorted(Rebranding.BACKENDS),
+                        help='sqlite: file in scratch directory, '
+                             'postgresql: throwaway local database')
+    parser.add_argument('-u', '--user', help='PostgreSQL user')
+    parser.add_argument('-d', '--database',
+                        help='PostgreSQL database or SQLite file')
+    parser.add_argument('--rows', type=int, default=ROWS,
+                        help='Rows in every table')
+    parser.add_argument('--ratio', type=float, default=RATIO,
+                        help='Share of rows with mails to change')
+    parser.add_argument('--tables', type=int, default=TABLES,
+                        help='Number of tables')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Number of runs of every strategy')
+    parser.add_argument('-b', '--batch-size', type=int,
+                        default=Rebranding.BATCH_SIZE,
+                        help='Rows of one query of batched strategies')
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+                        help='Workers of parallel strategy')
+    parser.add_argument('--scratch',
+                        help='Directory for config and SQLite file')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Save results to JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show output of Rebranding')
+    args = vars(parser.parse_args())
+    if args['backend'] == 'postgresql' and not (args['user'] and
+                                                args['database']):
+        parser.error('postgresql backend needs --user and --database')
+
+    scratch = args['scratch'] or tempfile.mkdtemp(prefix='rebrandingbench')
+    database = args['database'] or os.path.join(scratch, 'bench.db')
+    bench = Bench(args['backend'], args['user'], database, scratch,
+                  args['rows'], args['ratio'], args['tables'],
+                  args['verbose'])
+    results = []
+    print '%-9s %9s %9s %8s %11s %11s %8s %7s' % (
+        'strategy', 'rows', 'changed', 'seconds', 'rows/s', 'changed/s',
+        'RSS MB', 'left')
+    try:
+        for name in args['strategy'] or list(STRATEGIES):
+            options = STRATEGIES[name]
+            if options is not None:
+                options = dict(options)
+                options.setdefault('batch_size', args['batch_size'])
+            if name == 'parallel':
+                options['workers'] = args['workers']
+                # few ranges for every worker, so they end together
+                options['range_size'] = max(
+                    args['rows'] / (args['workers'] * 4), 1)
+            for i in xrange(args['repeat']):
+                matching = bench.seed()
+                result = bench.run(name, options, matching)
+                results.append(result)
+                print '%-9s %9d %9d %8.2f %11.1f %11.1f %8.1f %7d' % (
+                    name, result['rows'], result['changed'],
+                    result['seconds'], result['rows_per_second'],
+                    result['changed_per_second'],
+                    result['peak_rss'] / 1048576.0, result['left'])
+                sys.stdout.flush()
+    finally:
+        if not args['scratch']:
+            shutil.rmtree(scratch, True)
+
+    if args['json']:
+        with open(args['json'], 'w') as f:
+            json.dump({'backend': args['backend'],
+                       'rows': args['rows'],
+                       'ratio': args['ratio'],
+                       'tables': args['tables'],
+                       'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,15 @@
 #
 # OK:0, WARNING:1, CRITICAL:2, UNKNOWN:3
 #
+# Bulk mode checks all targets from file concurrently in one process,
+# one target per line (name is the rest of the line):
+# host port timeout name
+# ./TcpCheck.py -b targets.txt -c 256
+#
+# State of every target is kept in STATEFILE (SQLite), shared by all
+# checks. With --failures/--successes a target is CRITICAL (RESOLVED)
+# only after that many failures (successes) in a row, WARNING before.
+#
 # To run it you need to setup variables:
 # export MAIL_FROM ...
 # export MAIL_TO ...
@@ -17,15 +26,25 @@
 
 import os
 import sys
+import time
+import errno
+import select
+import sqlite3
 import argparse
 import smtplib
 import socket
 import logging
+from multiprocessing.pool import ThreadPool
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-TEMPFILE = "/tmp/TcpCheckFile.tmp"
+STATEFILE = "/tmp/TcpCheckState.db"
 DEBUG = True  # Setup True if you need to enable it
+FAILURES = 1  # failures in a row before CRITICAL
+SUCCESSES = 1  # successes in a row before RESOLVED
+CONCURRENCY = 256  # connections open at once in bulk mode
+RESOLVERS = 32  # threads resolving host names in bulk mode
+EXIT_CODES = {'OK': 0, 'RESOLVED': 0, 'WARNING': 1, 'CRITICAL': 2}
 
 
 class TcpCheck(object):
@@ -35,36 +54,30 @@ class TcpCheck(object):
         self.port = int(port)
         self.timeout = float(timeout) / float(3.02)
         self.name = name
+        self.key = "%s %s:%s" % (name, host, self.port)
         if DEBUG is False:
             self.mailfrom = os.environ["MAIL_FROM"]
             self.mailto = os.environ["MAIL_TO"]
 
-    def main(self):
+    def main(self, store):
         ''' main method, the logic is here '''
-        if self.status() != 0:
-            self.exit_code('CRITICAL')
-        else:
-            if os.path.exists(TEMPFILE):
-                self.exit_code('RESOLVED')
-            else:
-                self.exit_code('OK')
+        status = store.update([(self.key, self.status() == 0)])[0][0]
+        self.exit_code(status)
 
     def exit_code(self, status):
         ''' exit code method '''
+        self.alert(status)
+        sys.exit(EXIT_CODES[status])
+
+    def alert(self, status):
+        ''' sending e-mail for status, nothing while it is WARNING '''
         if status == 'CRITICAL':
-            self.status_save()
             self.send_mail('CRITICAL')
-            sys.exit(2)
         if status == 'OK':
-            if DEBUG is False:
-                sys.exit(0)
-            else:
+            if DEBUG is not False:
                 self.send_mail('OK')
-                sys.exit(0)
         if status == 'RESOLVED':
-            self.status_delete()
             self.send_mail('OK', 'RESOLVED')
-            sys.exit(0)
 
     def status(self):
         ''' checking connection '''
@@ -75,23 +88,6 @@ class TcpCheck(object):
         except:
             return 3
 
-    @staticmethod
-    def status_save():
-        ''' creating temp file '''
-        with open(TEMPFILE, 'w') as f:
-            f.write(str(1))
-
-    @staticmethod
-    def status_delete():
-        ''' deleting temp file '''
-        if os.path.exists(TEMPFILE):
-            try:
-                os.remove(TEMPFILE)
-            except Exception as error:
-                raise CheckErrorException(
-                    "Cannot delete file: %s. %s." %
-                    (TEMPFILE, error))
-
     def send_mail(self, status, problem="PROBLEM"):
         ''' sending e-mail '''
         if DEBUG is False:
@@ -111,6 +107,202 @@ class TcpCheck(object):
                   % (problem, self.host, status)
 
 
+class StateStore(object):
+    '''
+    StateStore keeps state of every target in SQLite file: last
+    alerted state, since when and failures and successes in a row.
+    Every update is one transaction, so many checks can share it.
+    :param filename: SQLite file
+    :param failures: failures in a row before CRITICAL
+    :param successes: successes in a row before RESOLVED
+    '''
+    def __init__(self, filename=STATEFILE, failures=FAILURES,
+                 successes=SUCCESSES):
+        self.filename = filename
+        self.failures = failures
+        self.successes = successes
+        try:
+            # transactions are started by update()
+            self.conn = sqlite3.connect(filename, timeout=30,
+                                        isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS state (
+                   target TEXT PRIMARY KEY,
+                   state TEXT NOT NULL,
+                   since REAL NOT NULL,
+                   failures INTEGER NOT NULL,
+                   successes INTEGER NOT NULL,
+                   checked REAL NOT NULL)""")
+        except sqlite3.Error as error:
+            raise CheckErrorException(
+                "Cannot open state: %s. %s." % (filename, error))
+
+    def update(self, results):
+        '''
+        saving results of checks, return list of (status, since,
+        failures in a row) in order of results
+        results: list of (target key, True when connection is open)
+        '''
+        now = time.time()
+        statuses = []
+        try:
+            # lock for writing at once, so nobody reads old state
+            self.conn.execute("BEGIN IMMEDIATE")
+            for key, ok in results:
+                row = self.conn.execute(
+                    "SELECT state, since, failures, successes FROM state "
+                    "WHERE target = ?", (key,)).fetchone()
+                state, since, failures, successes = row or ('OK', now, 0, 0)
+                if ok:
+                    failures, successes = 0, successes + 1
+                    if state != 'CRITICAL':
+                        status = 'OK'
+                    elif successes >= self.successes:
+                        state, since, status = 'OK', now, 'RESOLVED'
+                    else:
+                        status = 'WARNING'
+                else:
+                    failures, successes = failures + 1, 0
+                    if state == 'CRITICAL':
+                        status = 'CRITICAL'
+                    elif failures >= self.failures:
+                        state, since, status = 'CRITICAL', now, 'CRITICAL'
+                    else:
+                        status = 'WARNING'
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, state, since, failures, successes, now))
+                statuses.append((status, since, failures))
+            self.conn.execute("COMMIT")
+        except sqlite3.Error as error:
+            self.conn.rollback()
+            raise CheckErrorException(
+                "Cannot update state: %s. %s." % (self.filename, error))
+        return statuses
+
+
+class BulkCheck(object):
+    '''
+    BulkCheck will check many targets at once with non-blocking
+    sockets, a sweep takes about the longest timeout, not the sum.
+    :param targets: list of TcpCheck objects
+    :param store: StateStore object
+    :param concurrency: connections open at once
+    '''
+    def __init__(self, targets, store, concurrency=CONCURRENCY):
+        self.targets = targets
+        self.store = store
+        self.concurrency = concurrency
+
+    @staticmethod
+    def load(filename):
+        ''' reading TcpCheck objects from targets file '''
+        targets = []
+        try:
+            with open(filename) as f:
+                for number, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    fields = line.split(None, 3)
+                    if len(fields) != 4:
+                        raise ValueError("line %d: %s" % (number, line))
+                    targets.append(TcpCheck(*fields))
+        except (IOError, ValueError) as error:
+            raise CheckErrorException(
+                "Cannot read targets: %s. %s." % (filename, error))
+        return targets
+
+    @staticmethod
+    def resolve(host):
+        ''' address of host, None when it cannot be resolved '''
+        try:
+            return socket.getaddrinfo(host, None, socket.AF_INET,
+                                      socket.SOCK_STREAM)[0][4][0]
+        except socket.error:
+            return None
+
+    def addresses(self):
+        ''' resolving all host names, few of them at once '''
+        hosts = sorted(set(i.host for i in self.targets))
+        pool = ThreadPool(max(min(RESOLVERS, len(hosts)), 1))
+        try:
+            return dict(zip(hosts, pool.map(self.resolve, hosts)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def run(self):
+        '''
+        checking all targets, return list of results (like connect_ex,
+        0 is open) in order of targets
+        '''
+        results = [3] * len(self.targets)
+        addresses = self.addresses()
+        waiting = list(reversed(range(len(self.targets))))
+        poller = select.poll()
+        connecting = {}
+        while waiting or connecting:
+            # open new connections up to concurrency
+            while waiting and len(connecting) < self.concurrency:
+                n = waiting.pop()
+                target = self.targets[n]
+                address = addresses[target.host]
+                if address is None:
+                    continue
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setblocking(0)
+                code = s.connect_ex((address, target.port))
+                if code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    connecting[s.fileno()] = (
+                        s, n, time.time() + target.timeout)
+                    poller.register(s, select.POLLOUT)
+                else:
+                    results[n] = code
+                    s.close()
+            if not connecting:
+                continue
+
+            # wait for the first connection or the first timeout
+            deadline = min(i[2] for i in connecting.values())
+            events = poller.poll(max(deadline - time.time(), 0) * 1000)
+            for fd, event in events:
+                s, n, deadline = connecting.pop(fd)
+                poller.unregister(fd)
+                results[n] = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                s.close()
+            now = time.time()
+            for fd, (s, n, deadline) in connecting.items():
+                if deadline <= now:
+                    del connecting[fd]
+                    poller.unregister(fd)
+                    results[n] = errno.ETIMEDOUT
+                    s.close()
+        return results
+
+    def main(self):
+        ''' main method, checking all targets and alerting for them '''
+        start = time.time()
+        worst = 0
+        states = {}
+        results = self.store.update([
+            (target.key, code == 0)
+            for target, code in zip(self.targets, self.run())])
+        for target, (status, since, failures) in zip(self.targets, results):
+            target.alert(status)
+            states[status] = states.get(status, 0) + 1
+            worst = max(worst, EXIT_CODES[status])
+            print "%s: %s %s:%s since %s, %d failures in a row" % (
+                status, target.name, target.host, target.port,
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(since)),
+                failures)
+        print "Checked %d targets in %.2fs: %s" % (
+            len(self.targets), time.time() - start,
+            ', '.join("%s %d" % i for i in sorted(states.items())))
+        sys.exit(worst)
+
+
 class CheckErrorException(Exception):
     ''' Exception '''
     pass
@@ -122,15 +314,30 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="This plugin tests TCP \
                                      connections with the specified host.")
     parser.add_argument('-d', '--destination',
-                        help='Destination host', required=True)
+                        help='Destination host', required=False)
     parser.add_argument('-p', '--port',
-                        help='External port', required=True)
+                        help='External port', required=False)
     parser.add_argument('-t', '--timeout',
-                        help='Timeout in second', required=True)
+                        help='Timeout in second', required=False)
     parser.add_argument('-s', '--name',
-                        help='Service name', required=True)
+                        help='Service name', required=False)
     parser.add_argument('-f', '--filelog',
                         help='File log', required=False)
+    parser.add_argument('-b', '--bulk',
+                        help='Targets file: host port timeout name',
+                        required=False)
+    parser.add_argument('-c', '--concurrency', type=int, default=CONCURRENCY,
+                        help='Connections open at once in bulk mode',
+                        required=False)
+    parser.add_argument('--state', default=STATEFILE,
+                        help='SQLite file with state of every target',
+                        required=False)
+    parser.add_argument('--failures', type=int, default=FAILURES,
+                        help='Failures in a row before CRITICAL',
+                        required=False)
+    parser.add_argument('--successes', type=int, default=SUCCESSES,
+                        help='Successes in a row before RESOLVED',
+                        required=False)
 
     args = vars(parser.parse_args())
     d_set = args['destination']
@@ -138,6 +345,10 @@ if __name__ == '__main__':
     t_set = args['timeout']
     s_set = args['name']
     f_set = args['filelog']
+    if not args['bulk'] and not (d_set and p_set and t_set and s_set):
+        parser.error('-d, -p, -t and -s are required without --bulk')
+    if args['concurrency'] < 1:
+        parser.error('--concurrency must be at least 1')
 
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
@@ -148,6 +359,16 @@ if __name__ == '__main__':
     handler.setLevel(logging.INFO)
     logger.addHandler(handler)
 
-    if d_set and p_set and t_set:
-        start = TcpCheck(d_set, p_set, t_set, s_set)
-        start.main()
+    try:
+        store = StateStore(args['state'], args['failures'],
+                           args['successes'])
+        if args['bulk']:
+            start = BulkCheck(BulkCheck.load(args['bulk']), store,
+                              args['concurrency'])
+            start.main()
+        elif d_set and p_set and t_set:
+            start = TcpCheck(d_set, p_set, t_set, s_set)
+            start.main(store)
+    except CheckErrorException as error:
+        print error
+        sys.exit(3)